@@ -0,0 +1,470 @@
+"""Offline benchmark for the story and follower pipelines.
+
+Runs StealthInstagramBot against a stub instagrapi client and a local fake
+Telegram Bot API server on a virtual clock, so a full cycle takes seconds
+instead of minutes and needs no Instagram or Telegram account.
+
+    python benchmark.py --cycles 5 --stories 4 --rate-limit 0.1 --failure 0.05
+    python benchmark.py --min-success-rate 0.95 --max-cycle-seconds 2   # regression gate
+
+The same fakes back the tests in test_pipeline.py.
+"""
+import argparse
+import io
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytz
+from PIL import Image
+
+import main
+
+
+class VirtualClock(main.Clock):
+    """Clock whose waits return instantly and advance virtual time"""
+
+    def __init__(self, start=None):
+        self.current = start if start is not None else time.time()
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.current
+
+    def advance(self, seconds):
+        with self.lock:
+            self.current += max(0.0, seconds)
+
+    def wait(self, event, timeout):
+        if event.is_set():
+            return True
+        self.advance(timeout or 0)
+        return event.is_set()
+
+
+class StubInstagramClient:
+    """Stands in for instagrapi.Client, returning synthetic user info and stories"""
+
+    # Set by the benchmark before the bot is constructed
+    clock = None
+    cdn_url = None
+    stories_per_cycle = 3
+    video_ratio = 0.3
+    repost_ratio = 0.0  # fraction of new stories that re-post earlier media
+    latency = 1.5  # virtual seconds per Instagram request
+
+    def __init__(self):
+        self.settings = {}
+        self.username = "bench_account"
+        self.delay_range = None
+        self.requests = 0
+        self.follower_count = 1000
+        self.following_count = 300
+        self.stories = []
+        self.next_pk = 1000
+
+    def request(self):
+        self.requests += 1
+        self.clock.advance(self.latency)
+
+    def load_settings(self, path):
+        with open(path) as f:
+            self.settings = json.load(f)
+        return self.settings
+
+    def dump_settings(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.settings, f)
+        return True
+
+    def login_by_sessionid(self, sessionid):
+        self.request()
+        self.settings = {'authorization_data': {'sessionid': sessionid}}
+        return True
+
+    def user_info_by_username(self, username):
+        self.request()
+        return SimpleNamespace(
+            pk=424242,
+            username=username,
+            full_name="Bench Target",
+            follower_count=self.follower_count,
+            following_count=self.following_count
+        )
+
+    def user_stories(self, user_id):
+        self.request()
+        return list(self.stories)
+
+    def new_cycle(self):
+        """Post new stories and drift follower counts, like a live account would"""
+        taken_at = datetime.fromtimestamp(self.clock.time(), tz=pytz.UTC)
+        for _ in range(self.stories_per_cycle):
+            self.next_pk += 1
+            is_video = random.random() < self.video_ratio
+
+            # A re-post is new story pk with the image of an earlier one
+            image = self.next_pk
+            if self.next_pk > 1001 and random.random() < self.repost_ratio:
+                image = random.randint(1001, self.next_pk - 1)
+
+            thumbnail_url = f"{self.cdn_url}/media/{image}.jpg"
+            self.stories.append(SimpleNamespace(
+                pk=self.next_pk,
+                video_url=f"{self.cdn_url}/media/{image}.mp4" if is_video else None,
+                thumbnail_url=thumbnail_url,
+                taken_at=taken_at
+            ))
+
+        # Stories disappear from Instagram after 24h
+        cutoff = taken_at - timedelta(hours=24)
+        self.stories = [story for story in self.stories if story.taken_at > cutoff]
+
+        self.follower_count += random.randint(-3, 5)
+        self.following_count += random.randint(-1, 1)
+
+
+class FakeBotAPI:
+    """Local HTTP server speaking enough of the Bot API (and a media CDN) for the bot"""
+
+    def __init__(self, latency=0.005, rate_limit=0.0, failure=0.0, retry_after=3):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.failure = failure
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.reset()
+
+        self.photos = {}
+        self.video_bytes = b'\x00\x00\x00\x18ftypmp42' + b'\x00' * 256 * 1024
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Write headers and body in one segment, so delayed ACKs don't skew latency
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path.endswith('.mp4'):
+                    body = api.video_bytes
+                else:
+                    body = api.get_photo(self.path.rsplit('/', 1)[-1].split('.')[0])
+                api.count('cdn', 0, len(body))
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                self.wfile.flush()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                request_body = self.rfile.read(length)
+                method = self.path.rsplit('/', 1)[-1]
+                status, payload = api.respond(method, request_body)
+                body = json.dumps(payload).encode()
+                api.count(method, length, len(body), status)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def get_photo(self, name):
+        """A distinct (but stable) JPEG per media name, so perceptual hashes differ"""
+        with self.lock:
+            if name not in self.photos:
+                rng = random.Random(name)
+                image = Image.new('RGB', (360, 640))
+                for x in range(0, 360, 45):
+                    for y in range(0, 640, 80):
+                        image.paste(tuple(rng.randint(0, 255) for _ in range(3)), (x, y, x + 45, y + 80))
+                buffer = io.BytesIO()
+                image.save(buffer, 'JPEG', quality=80)
+                self.photos[name] = buffer.getvalue()
+            return self.photos[name]
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.statuses = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.file_counter = 0
+
+    def count(self, method, bytes_in, bytes_out, status=200):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def new_file_id(self):
+        with self.lock:
+            self.file_counter += 1
+            return f"FILE{self.file_counter}"
+
+    def respond(self, method, body=b''):
+        time.sleep(self.latency)
+        roll = random.random()
+        if roll < self.rate_limit:
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            }
+        if roll < self.rate_limit + self.failure:
+            return 502, {'ok': False, 'error_code': 502, 'description': "Bad Gateway"}
+
+        if method == 'sendMediaGroup':
+            # The benchmark doesn't parse the album; a photo result is enough for file_id capture
+            return 200, {'ok': True, 'result': [
+                {'message_id': i, 'photo': [{'file_id': self.new_file_id()}]} for i in range(10)
+            ]}
+        if method == 'sendVideo':
+            return 200, {'ok': True, 'result': {'message_id': 1, 'video': {'file_id': self.new_file_id()}}}
+        if method == 'sendPhoto':
+            return 200, {'ok': True, 'result': {'message_id': 1, 'photo': [{'file_id': self.new_file_id()}]}}
+        return 200, {'ok': True, 'result': {'message_id': 1}}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def drain_outbox(bot, clock, max_virtual_seconds=6 * 3600):
+    """Deliver queued jobs synchronously, advancing virtual time through retries"""
+    deadline = clock.time() + max_virtual_seconds
+    while clock.time() < deadline:
+        entry = bot.outbox.next_due()
+        if entry is None:
+            wait = bot.outbox.seconds_until_next()
+            if wait is None:
+                return
+            clock.advance(wait)
+            continue
+        bot.deliver_job(entry)
+
+
+def count_queued(bot, kind):
+    """Stories (or messages) currently queued in the outbox"""
+    total = 0
+    for (job,) in bot.state.query("SELECT job FROM outbox"):
+        job = json.loads(job)
+        if job['kind'] == kind:
+            total += len(job['stories']) if kind == 'stories' else 1
+    return total
+
+
+def counter_total(name, labels=None):
+    """Sum a main.metrics counter over series matching the given labels"""
+    total = 0
+    with main.metrics.lock:
+        for (metric, metric_labels), value in main.metrics.counters.items():
+            if metric == name and all(dict(metric_labels).get(k) == v for k, v in (labels or {}).items()):
+                total += value
+    return total
+
+
+def run_benchmark(args):
+    random.seed(args.seed)
+    state_dir = tempfile.mkdtemp(prefix="odwatch-bench-")
+    api = FakeBotAPI(latency=args.latency, rate_limit=args.rate_limit,
+                     failure=args.failure, retry_after=args.retry_after)
+    clock = VirtualClock()
+
+    StubInstagramClient.clock = clock
+    StubInstagramClient.cdn_url = api.url
+    StubInstagramClient.stories_per_cycle = args.stories
+    StubInstagramClient.video_ratio = args.video_ratio
+    StubInstagramClient.latency = args.instagram_latency
+    StubInstagramClient.repost_ratio = args.reposts
+
+    try:
+        bot = main.StealthInstagramBot(
+            "BENCH", ",".join(str(-1000 - i) for i in range(args.chats)), "bench_target",
+            "1" * 40, album_mode=not args.no_albums, state_dir=state_dir,
+            relay_mode=args.relay, clock=clock, client_class=StubInstagramClient,
+            dedup_mode=args.dedup
+        )
+        bot.telegram.base_url = f"{api.url}/botBENCH"
+        stub = bot.instagram_client
+
+        cycles = []
+        for cycle in range(args.cycles):
+            if cycle:
+                clock.advance(args.interval)
+            stub.new_cycle()
+            api.reset()
+            instagram_before = stub.requests
+            delivered_before = counter_total('odwatch_stories_delivered_total')
+            failed_before = counter_total('odwatch_stories_failed_total')
+            messages_before = counter_total('odwatch_telegram_calls_total',
+                                            {'method': 'sendMessage', 'status': 'success'})
+            virtual_start = clock.time()
+            wall_start = time.perf_counter()
+
+            # Stories
+            bot.process_stories(force=True)
+            queued_stories = count_queued(bot, 'stories')
+            queued_messages = count_queued(bot, 'message')
+            drain_outbox(bot, clock)
+            stories_wall = time.perf_counter() - wall_start
+
+            # Followers
+            followers_start = time.perf_counter()
+            bot.check_followers_changes_stealth(force=True)
+            queued_messages += count_queued(bot, 'message')
+            drain_outbox(bot, clock)
+            followers_wall = time.perf_counter() - followers_start
+
+            delivered = counter_total('odwatch_stories_delivered_total') - delivered_before
+            failed = counter_total('odwatch_stories_failed_total') - failed_before
+            messages = counter_total('odwatch_telegram_calls_total',
+                                     {'method': 'sendMessage', 'status': 'success'}) - messages_before
+            cdn_requests = api.requests.get('cdn', 0)
+            cycles.append({
+                'cycle': cycle + 1,
+                'wall_seconds': round(time.perf_counter() - wall_start, 4),
+                'stories_wall_seconds': round(stories_wall, 4),
+                'followers_wall_seconds': round(followers_wall, 4),
+                'virtual_seconds': round(clock.time() - virtual_start, 1),
+                'instagram_requests': stub.requests - instagram_before,
+                'telegram_requests': sum(api.requests.values()) - cdn_requests,
+                'cdn_requests': cdn_requests,
+                'telegram_methods': {k: v for k, v in api.requests.items() if k != 'cdn'},
+                'http_statuses': dict(api.statuses),
+                'bytes_sent': api.bytes_in,
+                'bytes_received': api.bytes_out,
+                'story_deliveries_queued': queued_stories,
+                'story_deliveries_ok': delivered,
+                'story_deliveries_failed': failed,
+                'messages_queued': queued_messages,
+                'messages_ok': messages
+            })
+
+        bot.shutdown()
+        return summarize(cycles)
+    finally:
+        api.close()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def summarize(cycles):
+    def rate(ok, total):
+        return round(ok / total, 4) if total else 1.0
+
+    story_ok = sum(c['story_deliveries_ok'] for c in cycles)
+    story_total = story_ok + sum(c['story_deliveries_failed'] for c in cycles)
+    message_ok = sum(c['messages_ok'] for c in cycles)
+    message_total = sum(c['messages_queued'] for c in cycles)
+    walls = sorted(c['wall_seconds'] for c in cycles)
+
+    return {
+        'cycles': cycles,
+        'summary': {
+            'cycles': len(cycles),
+            'wall_seconds_mean': round(sum(walls) / len(walls), 4) if walls else 0,
+            'wall_seconds_max': walls[-1] if walls else 0,
+            'virtual_seconds_mean': round(sum(c['virtual_seconds'] for c in cycles) / max(1, len(cycles)), 1),
+            'instagram_requests': sum(c['instagram_requests'] for c in cycles),
+            'telegram_requests': sum(c['telegram_requests'] for c in cycles),
+            'bytes_transferred': sum(c['bytes_sent'] + c['bytes_received'] for c in cycles),
+            'story_success_rate': rate(story_ok, story_total),
+            'message_success_rate': rate(message_ok, message_total),
+            'delivery_success_rate': rate(story_ok + message_ok, story_total + message_total)
+        }
+    }
+
+
+def print_report(result):
+    header = f"{'cycle':>5} {'wall s':>8} {'virt s':>8} {'ig req':>6} {'tg req':>6} {'bytes':>10} {'stories':>9} {'msgs':>6}"
+    print(header)
+    print("-" * len(header))
+    for c in result['cycles']:
+        stories = f"{c['story_deliveries_ok']}/{c['story_deliveries_ok'] + c['story_deliveries_failed']}"
+        messages = f"{c['messages_ok']}/{c['messages_queued']}"
+        print(f"{c['cycle']:>5} {c['wall_seconds']:>8.3f} {c['virtual_seconds']:>8.1f} "
+              f"{c['instagram_requests']:>6} {c['telegram_requests']:>6} "
+              f"{c['bytes_sent'] + c['bytes_received']:>10} {stories:>9} {messages:>6}")
+    print()
+    for key, value in result['summary'].items():
+        print(f"{key:>24}: {value}")
+
+
+def check_gates(summary, args):
+    """Return a list of regression gate failures"""
+    failures = []
+    if args.max_cycle_seconds is not None and summary['wall_seconds_max'] > args.max_cycle_seconds:
+        failures.append(f"max cycle wall time {summary['wall_seconds_max']}s > {args.max_cycle_seconds}s")
+    if args.min_success_rate is not None and summary['delivery_success_rate'] < args.min_success_rate:
+        failures.append(f"delivery success rate {summary['delivery_success_rate']} < {args.min_success_rate}")
+    if args.max_telegram_requests is not None and summary['telegram_requests'] > args.max_telegram_requests:
+        failures.append(f"telegram requests {summary['telegram_requests']} > {args.max_telegram_requests}")
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the odwatch pipeline")
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--stories', type=int, default=4, help="new stories per cycle")
+    parser.add_argument('--video-ratio', type=float, default=0.3)
+    parser.add_argument('--reposts', type=float, default=0.0, help="fraction of new stories re-posting earlier media")
+    parser.add_argument('--dedup', choices=['reference', 'suppress', 'off'], default='reference')
+    parser.add_argument('--interval', type=float, default=3 * 3600, help="virtual seconds between cycles")
+    parser.add_argument('--chats', type=int, default=1, help="destination chats")
+    parser.add_argument('--no-albums', action='store_true', help="send stories one by one")
+    parser.add_argument('--relay', action='store_true', help="download and upload media (relay mode)")
+    parser.add_argument('--latency', type=float, default=0.005, help="fake Bot API latency (real seconds)")
+    parser.add_argument('--instagram-latency', type=float, default=1.5, help="stub Instagram latency (virtual seconds)")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="fraction of Bot API calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=3)
+    parser.add_argument('--failure', type=float, default=0.0, help="fraction of Bot API calls answered with 502")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the full result as JSON")
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--max-cycle-seconds', type=float, help="fail if any cycle takes longer (wall time)")
+    parser.add_argument('--min-success-rate', type=float, help="fail if delivery success rate is lower")
+    parser.add_argument('--max-telegram-requests', type=int, help="fail if more Bot API requests are issued")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    main.setup_logging('INFO' if args.verbose else 'WARNING')
+    if not args.verbose:
+        # Expected failures (injected 429s/502s) are part of the benchmark
+        logging.getLogger("odwatch").setLevel(logging.CRITICAL)
+
+    result = run_benchmark(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+    failures = check_gates(result['summary'], args)
+    for failure in failures:
+        print(f"❌ Regression gate failed: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,35 +1,1154 @@
 import requests
 import time
 import json
+import hashlib
+import mimetypes
+import io
 import os
-from datetime import datetime
+import sqlite3
+import signal
+import threading
+import logging
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from collections import OrderedDict
 import pytz
 from instagrapi import Client
+from instagrapi.exceptions import LoginRequired, ClientLoginRequired, ClientUnauthorizedError
 import random
 import urllib.parse
+import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from PIL import Image
 
 # Israel timezone
 ISRAEL_TZ = pytz.timezone('Asia/Jerusalem')
 
+logger = logging.getLogger("odwatch")
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per log line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, tz=ISRAEL_TZ).isoformat(),
+            'level': record.levelname.lower(),
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level="INFO", log_format="text"):
+    """Configure the root logger (text or JSON lines)"""
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s [%(threadName)s] %(message)s"))
+    logging.basicConfig(level=getattr(logging, level.upper(), logging.INFO), handlers=[handler], force=True)
+
+
+class Metrics:
+    """Thread-safe counters and timing histograms, exported as Prometheus text or JSON"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> {'buckets': [...], 'sum': x, 'count': n}
+
+    def key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        """Increment a counter"""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """Record a duration (seconds) in a histogram"""
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """Time a block into a histogram"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, labels)
+
+    def cache(self, cache, hit):
+        """Count a cache hit or miss"""
+        self.inc('odwatch_cache_requests_total', {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+    def format_labels(self, labels, extra=None):
+        pairs = list(labels) + list(extra or [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """Snapshot of all metrics as plain data"""
+        with self.lock:
+            return {
+                'time': datetime.now(ISRAEL_TZ).isoformat(),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'histograms': [
+                    {
+                        'name': name,
+                        'labels': dict(labels),
+                        'count': histogram['count'],
+                        'sum': round(histogram['sum'], 6),
+                        'buckets': dict(zip([str(b) for b in self.BUCKETS], histogram['buckets']))
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ]
+            }
+
+    def dump_json(self, path):
+        """Atomically write the JSON snapshot to a file"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def start_http_server(self, port, host="127.0.0.1"):
+        """Serve /metrics (Prometheus) and /metrics.json on a local port"""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.render_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics.to_dict()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"📊 Metrics on http://{host}:{server.server_port}/metrics")
+        return server
+
+    def start_json_dump(self, path, interval=60):
+        """Periodically dump the JSON snapshot to a file"""
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump_json(path)
+                except OSError as e:
+                    logger.warning(f"⚠️ Could not dump metrics: {e}")
+
+        threading.Thread(target=dump_loop, name="metrics-dump", daemon=True).start()
+
+
+metrics = Metrics()
+
+
+class ShutdownRequested(BaseException):
+    """Raised inside a check cycle when the bot is shutting down"""
+
+
+class DeliveryUnconfirmed(Exception):
+    """A Telegram send may have gone through; resending it could post a duplicate"""
+
+
+class Clock:
+    """Wall clock with interruptible waits (swap in a virtual clock for tests/benchmarks)"""
+
+    def time(self):
+        return time.time()
+
+    def now(self, tz=ISRAEL_TZ):
+        return datetime.fromtimestamp(self.time(), tz=tz)
+
+    def wait(self, event, timeout):
+        """Wait up to timeout seconds, returns True if the event was set"""
+        return event.wait(timeout)
+
+    def sleep(self, seconds):
+        """Wait that can't be interrupted"""
+        self.wait(threading.Event(), seconds)
+
+
+class Scheduler:
+    """Interruptible waits between check cycles, with shutdown and run-now requests"""
+
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        self.run_requested = False
+
+    @property
+    def stopping(self):
+        return self.stop_event.is_set()
+
+    def request_stop(self):
+        """Ask the bot to shut down (safe to call from a signal handler)"""
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def request_run(self):
+        """Ask for an immediate check cycle"""
+        self.run_requested = True
+        self.wakeup.set()
+
+    def wait_for_next_run(self, seconds):
+        """Wait until the next run is due; returns 'due', 'run' (on demand) or 'stop'"""
+        deadline = self.clock.time() + seconds
+        while True:
+            if self.stopping:
+                return 'stop'
+            if self.run_requested:
+                self.run_requested = False
+                return 'run'
+
+            remaining = deadline - self.clock.time()
+            if remaining <= 0:
+                return 'due'
+            self.clock.wait(self.wakeup, remaining)
+            self.wakeup.clear()
+
+    def pause(self, seconds):
+        """Sleep inside a cycle, raising ShutdownRequested if the bot is stopping"""
+        if self.clock.wait(self.stop_event, seconds) or self.stopping:
+            raise ShutdownRequested()
+
+
+class TokenBucket:
+    """Token bucket whose rate backs off on 429s and recovers on successes"""
+
+    def __init__(self, rate, capacity, now):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, cost, now):
+        """Seconds until a send of cost tokens may go out"""
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # A send larger than the bucket waits for a full bucket, then leaves it in debt
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed - 1e-9:
+            return 0.0
+        return max(0.001, (needed - self.tokens) / self.rate)
+
+    def consume(self, cost):
+        self.tokens -= cost
+
+    def penalize(self, retry_after, now):
+        """Telegram said slow down: pause for retry_after and halve the rate"""
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.rate = max(self.base_rate / 8, self.rate / 2)
+        self.tokens = 0
+        self.updated = now
+
+    def reward(self):
+        """Recover the rate slowly after successful sends"""
+        self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+class RateLimiter:
+    """Per-chat token buckets plus one global bucket, sized from the Bot API limits"""
+
+    GLOBAL_RATE = 30.0          # ~30 messages/s per bot
+    PRIVATE_RATE = 1.0          # ~1 message/s per chat
+    GROUP_RATE = 20.0 / 60.0    # 20 messages/min per group or channel
+
+    def __init__(self, clock, stop_event):
+        self.clock = clock
+        self.stop_event = stop_event
+        self.drain_deadline = None  # While stopping, sends keep being paced until this time
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE, clock.time())
+        self.chat_buckets = {}
+
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative, channels can also be addressed as @username
+            if str(chat_id).startswith(('-', '@')):
+                bucket = TokenBucket(self.GROUP_RATE, 20, self.clock.time())
+            else:
+                bucket = TokenBucket(self.PRIVATE_RATE, 1, self.clock.time())
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def acquire(self, chat_id, cost=1):
+        """Block until a send of cost messages is allowed; False if it can't go out before shutdown"""
+        started = self.clock.time()
+        while True:
+            with self.lock:
+                now = self.clock.time()
+                buckets = [self.global_bucket]
+                if chat_id is not None:
+                    buckets.append(self.get_chat_bucket(chat_id))
+                delay = max(bucket.delay_for(cost, now) for bucket in buckets)
+                if delay <= 0:
+                    for bucket in buckets:
+                        bucket.consume(cost)
+                    if now > started:
+                        metrics.observe('odwatch_telegram_pacing_seconds', now - started)
+                    return True
+
+            if self.stop_event.is_set():
+                # Draining for shutdown: wait only if the send still fits before the deadline
+                if self.drain_deadline is None or now + delay > self.drain_deadline:
+                    return False
+                self.clock.sleep(delay)
+            else:
+                # A shutdown request wakes the wait up to re-check against the deadline
+                self.clock.wait(self.stop_event, delay)
+
+    def penalize(self, chat_id, retry_after):
+        with self.lock:
+            bucket = self.global_bucket if chat_id is None else self.get_chat_bucket(chat_id)
+            bucket.penalize(retry_after, self.clock.time())
+
+    def reward(self, chat_id):
+        with self.lock:
+            if chat_id is not None:
+                self.get_chat_bucket(chat_id).reward()
+            self.global_bucket.reward()
+
+
+class TelegramClient:
+    """Pooled keep-alive transport for the Telegram Bot API"""
+
+    def __init__(self, bot_token, max_retries=4, backoff_base=1.0, backoff_cap=60.0, pool_size=10,
+                 stop_event=None, clock=None):
+        self.base_url = f"https://api.telegram.org/bot{bot_token}"
+        self.max_retries = max_retries
+        self.stop_event = stop_event or threading.Event()  # Set on shutdown to abandon retry waits
+        self.clock = clock or Clock()
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        # Paces every send to the documented per-chat and global limits
+        self.rate_limiter = RateLimiter(self.clock, self.stop_event)
+
+        # One session for every call so the TLS connection is reused
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+
+    def get_backoff_delay(self, attempt):
+        """Capped exponential backoff with jitter"""
+        delay = min(self.backoff_cap, self.backoff_base * (2 ** attempt))
+        return delay + random.uniform(0, delay / 2)
+
+    def parse_response(self, response):
+        """Parse the Bot API JSON body, tolerating non-JSON error pages"""
+        try:
+            return response.json()
+        except ValueError:
+            return {'ok': False, 'error_code': response.status_code, 'description': response.text[:200]}
+
+    def is_unsent(self, error):
+        """True if a network error happened before the request reached Telegram"""
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        # Refused connections and DNS failures are wrapped in a MaxRetryError
+        reason = getattr(error.args[0] if error.args else None, 'reason', None)
+        return isinstance(reason, NewConnectionError)
+
+    def rewind_files(self, files):
+        """Rewind file objects so a retried upload sends the full body again"""
+        for value in (files or {}).values():
+            file_obj = value[1] if isinstance(value, tuple) else value
+            if hasattr(file_obj, 'seek'):
+                file_obj.seek(0)
+
+    def call(self, method, data=None, files=None, timeout=30, headers=None, chat_id=None, cost=1):
+        """Call a Bot API method and return its result, or None on failure
+
+        Raises DeliveryUnconfirmed if the request may have been delivered anyway.
+        """
+        if chat_id is None and isinstance(data, dict):
+            chat_id = data.get('chat_id')
+        
+        status = 'failure'
+        try:
+            with metrics.timer('odwatch_telegram_call_seconds', {'method': method}):
+                result = self.call_with_retries(method, data, files, timeout, headers, chat_id, cost)
+            if result is not None:
+                status = 'success'
+            return result
+        except DeliveryUnconfirmed:
+            status = 'unconfirmed'
+            raise
+        finally:
+            metrics.inc('odwatch_telegram_calls_total', {'method': method, 'status': status})
+
+    def call_with_retries(self, method, data, files, timeout, headers, chat_id, cost):
+        url = f"{self.base_url}/{method}"
+
+        for attempt in range(self.max_retries + 1):
+            retry_delay = 0
+
+            if not self.rate_limiter.acquire(chat_id, cost):
+                logger.warning(f"⚠️ Telegram {method} abandoned, shutting down")
+                return None
+
+            try:
+                self.rewind_files(files)
+                if hasattr(data, 'seek'):
+                    data.seek(0)
+                response = self.session.post(url, data=data, files=files, timeout=timeout, headers=headers)
+                body = self.parse_response(response)
+
+                if response.status_code == 200 and body.get('ok'):
+                    self.rate_limiter.reward(chat_id)
+                    return body.get('result', True)
+
+                description = body.get('description', '')
+                if response.status_code == 429:
+                    retry_after = float((body.get('parameters') or {}).get('retry_after', 1))
+                    # The rate limiter holds the next attempt back and slows this chat down
+                    self.rate_limiter.penalize(chat_id, retry_after)
+                    metrics.inc('odwatch_telegram_retries_total', {'method': method, 'reason': 'rate_limited'})
+                    logger.info(f"⏳ Telegram {method} rate limited, retrying in {retry_after:.0f}s")
+                elif response.status_code >= 500:
+                    retry_delay = self.get_backoff_delay(attempt)
+                    metrics.inc('odwatch_telegram_retries_total', {'method': method, 'reason': 'server_error'})
+                    logger.warning(f"⚠️ Telegram {method} server error {response.status_code}: {description}")
+                else:
+                    # Other 4xx errors will not succeed on retry
+                    logger.error(f"❌ Telegram {method} failed ({response.status_code}): {description}")
+                    return None
+
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not self.is_unsent(e):
+                    # The request may have been delivered, resending could duplicate the message
+                    logger.warning(f"⚠️ Telegram {method} outcome unknown, not resending: {e}")
+                    raise DeliveryUnconfirmed(f"Telegram {method} outcome unknown") from e
+                retry_delay = self.get_backoff_delay(attempt)
+                metrics.inc('odwatch_telegram_retries_total', {'method': method, 'reason': 'network'})
+                logger.warning(f"⚠️ Telegram {method} network error: {e}")
+            except Exception as e:
+                logger.error(f"❌ Error calling Telegram {method}: {e}")
+                return None
+
+            if attempt < self.max_retries:
+                if self.clock.wait(self.stop_event, retry_delay):
+                    logger.warning(f"⚠️ Telegram {method} retry abandoned, shutting down")
+                    return None
+
+        logger.error(f"❌ Telegram {method} failed after {self.max_retries + 1} attempts")
+        return None
+
+    def upload(self, method, data, files, timeout=300, cost=1):
+        """Call a Bot API method with local files streamed as multipart/form-data"""
+        body = MultipartStream(data, files)
+        try:
+            return self.call(method, data=body, timeout=timeout, headers={
+                'Content-Type': body.content_type,
+                'Content-Length': str(len(body))
+            }, chat_id=data.get('chat_id'), cost=cost)
+        finally:
+            body.close()
+
+    def close(self):
+        """Close pooled connections"""
+        self.session.close()
+
+
+class MultipartStream(io.RawIOBase):
+    """multipart/form-data body that streams files from disk instead of buffering them"""
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.parts = []
+
+        for name, value in fields.items():
+            self.parts.append(
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n".encode()
+            )
+        for name, path in files.items():
+            filename = os.path.basename(path)
+            mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self.parts.append(
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {mime_type}\r\n\r\n".encode()
+            )
+            self.parts.append(path)
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+
+        self.length = sum(
+            os.path.getsize(part) if isinstance(part, str) else len(part)
+            for part in self.parts
+        )
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Only rewinding is needed (for retries)
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartStream can only be rewound")
+        self.close_current()
+        self.part_index = 0
+        self.current = None
+        self.position = 0
+        return 0
+
+    def tell(self):
+        return self.position
+
+    def close_current(self):
+        current = getattr(self, 'current', None)
+        if current is not None:
+            current.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        chunks = []
+        while size > 0 and self.part_index < len(self.parts):
+            if self.current is None:
+                part = self.parts[self.part_index]
+                self.current = open(part, 'rb') if isinstance(part, str) else io.BytesIO(part)
+            chunk = self.current.read(size)
+            if not chunk:
+                self.current.close()
+                self.current = None
+                self.part_index += 1
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.position += len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        self.close_current()
+        self.current = None
+        super().close()
+
+
+class StateStore:
+    """Crash-safe SQLite (WAL) backend for all bot state"""
+
+    def __init__(self, db_path, clock=None):
+        self.db_path = db_path
+        self.clock = clock or Clock()
+        self.lock = threading.RLock()
+        self.in_transaction = False
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+
+        # WAL keeps the last committed state intact if we crash mid-write
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                name TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS count_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                observed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS count_history_kind ON count_history (kind, observed_at);
+        """)
+        self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Group several writes into one atomic transaction (nested calls join the outer one)"""
+        with self.lock:
+            if self.in_transaction:
+                yield
+                return
+            self.in_transaction = True
+            try:
+                with self.conn:
+                    yield
+            finally:
+                self.in_transaction = False
+
+    def execute(self, sql, params=()):
+        """Run a single statement in its own transaction, or in the current one"""
+        with self.transaction():
+            return self.conn.execute(sql, params)
+
+    def query(self, sql, params=()):
+        """Run a read query and return all rows"""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def load_snapshot(self, name, default=None):
+        """Load a JSON snapshot by name"""
+        rows = self.query("SELECT data FROM snapshots WHERE name = ?", (name,))
+        if not rows:
+            return default
+        return json.loads(rows[0][0])
+
+    def save_snapshots(self, snapshots):
+        """Atomically save several named JSON snapshots"""
+        now = self.clock.time()
+        with self.transaction():
+            for name, data in snapshots.items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO snapshots (name, data, updated_at) VALUES (?, ?, ?)",
+                    (name, json.dumps(data), now)
+                )
+
+    def record_count(self, kind, count, observed_at=None):
+        """Append an observed follower/following count to the history"""
+        self.execute(
+            "INSERT INTO count_history (kind, count, observed_at) VALUES (?, ?, ?)",
+            (kind, count, observed_at or self.clock.time())
+        )
+
+    def get_count_history(self, kind, since=None):
+        """Return [(observed_at, count)] for a kind, oldest first"""
+        return self.query(
+            "SELECT observed_at, count FROM count_history WHERE kind = ? AND observed_at >= ? "
+            "ORDER BY observed_at",
+            (kind, since or 0)
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SentStoriesStore:
+    """Persistent dedup store for delivered stories, expiring 24h after taken_at"""
+
+    def __init__(self, state, ttl=timedelta(hours=24), clock=None):
+        self.state = state
+        self.ttl = ttl
+        self.clock = clock or Clock()
+        self.state.execute(
+            "CREATE TABLE IF NOT EXISTS sent_stories ("
+            "story_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self.state.execute("CREATE INDEX IF NOT EXISTS sent_stories_expires ON sent_stories (expires_at)")
+
+        # story_id -> expiry timestamp, for O(1) lookups
+        self.expiry = {}
+        self.load()
+
+    def load(self):
+        """Drop expired rows and load only the unexpired keys"""
+        now = self.clock.time()
+        self.state.execute("DELETE FROM sent_stories WHERE expires_at <= ?", (now,))
+        rows = self.state.query("SELECT story_id, expires_at FROM sent_stories")
+        self.expiry = dict(rows)
+        logger.info(f"📂 Loaded {len(self.expiry)} sent stories")
+
+    def get_expiry(self, taken_at):
+        """Expiry timestamp for a story taken at the given time"""
+        if taken_at is None:
+            taken_at = self.clock.now(pytz.UTC)
+        elif taken_at.tzinfo is None:
+            taken_at = pytz.UTC.localize(taken_at)
+        return (taken_at + self.ttl).timestamp()
+
+    def add(self, story_id, taken_at=None):
+        """Record a delivered story"""
+        expires_at = self.get_expiry(taken_at)
+        with self.state.lock:
+            self.expiry[story_id] = expires_at
+        try:
+            self.state.execute(
+                "INSERT OR REPLACE INTO sent_stories (story_id, expires_at) VALUES (?, ?)",
+                (story_id, expires_at)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"❌ Error saving sent story: {e}")
+
+    def prune(self):
+        """Remove expired entries from memory and disk"""
+        now = self.clock.time()
+        with self.state.lock:
+            self.expiry = {key: exp for key, exp in self.expiry.items() if exp > now}
+            self.state.execute("DELETE FROM sent_stories WHERE expires_at <= ?", (now,))
+
+    def __contains__(self, story_id):
+        expires_at = self.expiry.get(story_id)
+        if expires_at is None:
+            return False
+        if expires_at <= self.clock.time():
+            del self.expiry[story_id]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.expiry)
+
+
+class Outbox:
+    """Persistent queue of pending Telegram deliveries"""
+
+    def __init__(self, state, max_attempts=8, retry_base=60, retry_cap=3600, clock=None):
+        self.state = state
+        self.clock = clock or Clock()
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.state.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL)"
+        )
+
+        # Set whenever a job is queued, to wake the delivery worker
+        self.wakeup = threading.Event()
+
+        # Story ids with a delivery still queued, so they aren't queued twice
+        self.pending_story_ids = set()
+        self.refresh_pending()
+        logger.info(f"📬 Outbox has {len(self)} pending jobs")
+
+    def refresh_pending(self):
+        # Under the state lock, so a concurrent put() can't land between the query and the swap
+        with self.state.lock:
+            story_ids = set()
+            for (job,) in self.state.query("SELECT job FROM outbox"):
+                for story in json.loads(job).get('stories', []):
+                    story_ids.add(story['id'])
+            self.pending_story_ids = story_ids
+
+    def put(self, job):
+        """Queue a delivery job (a JSON-serializable dict)"""
+        with self.state.lock:
+            self.state.execute(
+                "INSERT INTO outbox (job, next_attempt_at) VALUES (?, ?)",
+                (json.dumps(job), self.clock.time())
+            )
+            for story in job.get('stories', []):
+                self.pending_story_ids.add(story['id'])
+        self.wakeup.set()
+
+    def next_due(self):
+        """Return the oldest job that is due, or None"""
+        rows = self.state.query(
+            "SELECT id, job, attempts FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT 1",
+            (self.clock.time(),)
+        )
+        if not rows:
+            return None
+        job_id, job, attempts = rows[0]
+        return {'id': job_id, 'attempts': attempts, 'job': json.loads(job)}
+
+    def seconds_until_next(self):
+        """Seconds until the next job is due, or None if the outbox is empty"""
+        rows = self.state.query("SELECT MIN(next_attempt_at) FROM outbox")
+        if rows[0][0] is None:
+            return None
+        return max(0.0, rows[0][0] - self.clock.time())
+
+    def complete(self, entry):
+        """Remove a finished (or abandoned) job"""
+        self.state.execute("DELETE FROM outbox WHERE id = ?", (entry['id'],))
+        self.refresh_pending()
+
+    def update(self, entry, job):
+        """Replace a job's payload, keeping its attempts and schedule"""
+        self.state.execute("UPDATE outbox SET job = ? WHERE id = ?", (json.dumps(job), entry['id']))
+        self.refresh_pending()
+
+    def retry(self, entry, job=None):
+        """Reschedule a failed job with backoff, optionally with a reduced payload"""
+        attempts = entry['attempts'] + 1
+        if attempts >= self.max_attempts:
+            logger.error(f"❌ Giving up on delivery after {attempts} attempts")
+            self.complete(entry)
+            return
+
+        delay = min(self.retry_cap, self.retry_base * (2 ** (attempts - 1)))
+        self.state.execute(
+            "UPDATE outbox SET job = ?, attempts = ?, next_attempt_at = ? WHERE id = ?",
+            (json.dumps(job or entry['job']), attempts, self.clock.time() + delay, entry['id'])
+        )
+        self.refresh_pending()
+        logger.info(f"⏳ Delivery retry {attempts}/{self.max_attempts} in {delay:.0f}s")
+
+    def has_story(self, story_id):
+        return story_id in self.pending_story_ids
+
+    def __len__(self):
+        return self.state.query("SELECT COUNT(*) FROM outbox")[0][0]
+
+
+class MediaHashIndex:
+    """Persistent, bounded index of perceptual hashes of sent story media"""
+
+    def __init__(self, state, window=timedelta(days=7), max_entries=2000, threshold=6, clock=None):
+        self.state = state
+        self.window = window
+        self.max_entries = max_entries
+        self.threshold = threshold  # Max differing bits (of 64) to count as the same media
+        self.clock = clock or Clock()
+        self.state.execute(
+            "CREATE TABLE IF NOT EXISTS media_hashes ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, hash TEXT NOT NULL, "
+            "story_id TEXT NOT NULL, seen_at REAL NOT NULL)"
+        )
+        self.entries = []  # [(hash int, story_id, seen_at)], oldest first
+        self.load()
+
+    @staticmethod
+    def compute_hash(image):
+        """64-bit difference hash (dHash) of an image"""
+        small = image.convert('L').resize((9, 8), Image.LANCZOS)
+        pixels = list(small.getdata())
+        value = 0
+        for row in range(8):
+            for col in range(8):
+                left = pixels[row * 9 + col]
+                right = pixels[row * 9 + col + 1]
+                value = (value << 1) | (1 if left > right else 0)
+        return value
+
+    def load(self):
+        """Drop entries outside the window and load the rest"""
+        self.prune()
+        rows = self.state.query("SELECT hash, story_id, seen_at FROM media_hashes ORDER BY id")
+        self.entries = [(int(value, 16), story_id, seen_at) for value, story_id, seen_at in rows]
+        logger.info(f"📂 Loaded {len(self.entries)} media hashes")
+
+    def prune(self):
+        """Enforce the time window and the size bound, in memory and on disk"""
+        cutoff = self.clock.time() - self.window.total_seconds()
+        with self.state.lock:
+            self.entries = [entry for entry in self.entries if entry[2] > cutoff][-self.max_entries:]
+            self.state.execute("DELETE FROM media_hashes WHERE seen_at <= ?", (cutoff,))
+            self.state.execute(
+                "DELETE FROM media_hashes WHERE id NOT IN "
+                "(SELECT id FROM media_hashes ORDER BY id DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+    def is_distinctive(self, value):
+        """Near-uniform images (plain backgrounds) hash to almost all zeros and would collide"""
+        return bin(value).count('1') >= 8
+
+    def matches(self, value, other):
+        return bin(value ^ other).count('1') <= self.threshold
+
+    def find(self, value):
+        """Return (story_id, seen_at) of a matching hash within the window, or None"""
+        cutoff = self.clock.time() - self.window.total_seconds()
+        for other, story_id, seen_at in reversed(self.entries):
+            if seen_at > cutoff and self.matches(value, other):
+                return story_id, seen_at
+        return None
+
+    def add(self, value, story_id):
+        now = self.clock.time()
+        with self.state.lock:
+            self.entries.append((value, story_id, now))
+            self.state.execute(
+                "INSERT INTO media_hashes (hash, story_id, seen_at) VALUES (?, ?, ?)",
+                (format(value, '016x'), story_id, now)
+            )
+        if len(self.entries) > self.max_entries:
+            self.prune()
+
+
+class MediaCache:
+    """Bounded, content-addressed on-disk cache for relayed story media"""
+
+    # Telegram Bot API upload limits
+    MAX_PHOTO_BYTES = 10 * 1024 * 1024
+    MAX_PHOTO_DIMENSIONS = 10000  # width + height
+    MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+    def __init__(self, cache_dir, max_bytes=500 * 1024 * 1024, chunk_size=64 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # key (story id) -> cached file path
+        self.index = {}
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+    def get_extension(self, url, media_type):
+        ext = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+        if ext in ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.mp4', '.mov'):
+            return ext
+        return '.mp4' if media_type == 'video' else '.jpg'
+
+    def touch(self, path):
+        """Mark a file as recently used (LRU order is by mtime)"""
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def fetch(self, key, url, media_type):
+        """Stream media into the cache and return its local path, or None"""
+        path = self.index.get(key)
+        if path and os.path.exists(path):
+            metrics.cache('media', hit=True)
+            self.touch(path)
+            return path
+        metrics.cache('media', hit=False)
+
+        tmp_path = os.path.join(self.cache_dir, f".download-{uuid.uuid4().hex}")
+        digest = hashlib.sha256()
+        size = 0
+
+        try:
+            with self.session.get(url, stream=True, timeout=(10, 60)) as response:
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.MAX_UPLOAD_BYTES and media_type == 'video':
+                            raise ValueError("video exceeds Telegram upload limit")
+                        digest.update(chunk)
+                        f.write(chunk)
+
+            path = os.path.join(self.cache_dir, digest.hexdigest() + self.get_extension(url, media_type))
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                self.touch(path)
+            else:
+                os.replace(tmp_path, path)
+
+            if media_type == 'photo':
+                path = self.fit_photo(path)
+
+            self.index[key] = path
+            return path
+
+        except Exception as e:
+            logger.error(f"❌ Error caching media: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+    def fetch_bytes(self, url, max_bytes=MAX_PHOTO_BYTES):
+        """Download a small image (e.g. a video thumbnail) into memory, or None"""
+        try:
+            with self.session.get(url, stream=True, timeout=(10, 30)) as response:
+                response.raise_for_status()
+                buffer = io.BytesIO()
+                for chunk in response.iter_content(self.chunk_size):
+                    buffer.write(chunk)
+                    if buffer.tell() > max_bytes:
+                        raise ValueError("image too large to hash")
+                return buffer.getvalue()
+        except Exception as e:
+            logger.warning(f"⚠️ Could not fetch image: {e}")
+            return None
+
+    def fit_photo(self, path):
+        """Downscale a photo that exceeds Telegram's size or dimension limits"""
+        with Image.open(path) as image:
+            width, height = image.size
+            if os.path.getsize(path) <= self.MAX_PHOTO_BYTES and width + height <= self.MAX_PHOTO_DIMENSIONS:
+                return path
+
+            scale = min(1.0, self.MAX_PHOTO_DIMENSIONS / float(width + height))
+            image = image.convert('RGB')
+            tmp_path = os.path.join(self.cache_dir, f".resize-{uuid.uuid4().hex}.jpg")
+
+            while True:
+                size = (max(1, int(width * scale)), max(1, int(height * scale)))
+                image.resize(size, Image.LANCZOS).save(tmp_path, 'JPEG', quality=85)
+                if os.path.getsize(tmp_path) <= self.MAX_PHOTO_BYTES:
+                    break
+                scale *= 0.75
+
+        logger.info(f"🗜️ Downscaled photo from {width}x{height} to {size[0]}x{size[1]}")
+        digest = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+        resized_path = os.path.join(self.cache_dir, digest.hexdigest() + '.jpg')
+        os.replace(tmp_path, resized_path)
+        
+        # The original can never be uploaded, so don't keep it around
+        os.remove(path)
+        return resized_path
+
+    def evict(self):
+        """Delete least recently used files until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+
+        live_paths = {path for _, _, path in entries if os.path.exists(path)}
+        self.index = {key: path for key, path in self.index.items() if path in live_paths}
+
+
 class StealthInstagramBot:
-    def __init__(self, bot_token, chat_id, instagram_username, ig_sessionid=None):
+    DEDUP_MODES = ('reference', 'suppress', 'off')
+    
+    def __init__(self, bot_token, chat_id, instagram_username, ig_sessionid=None, album_mode=True, state_dir=".",
+                 relay_mode=False, media_cache_bytes=500 * 1024 * 1024, user_info_ttl=900, clock=None,
+                 client_class=Client, dedup_mode="reference", dedup_window_days=7):
         self.bot_token = bot_token
-        self.chat_id = chat_id
+        
+        # One or more destination chats; the first one is the primary chat
+        if isinstance(chat_id, (list, tuple)):
+            self.chat_ids = [str(c).strip() for c in chat_id if str(c).strip()]
+        else:
+            self.chat_ids = [c.strip() for c in str(chat_id).split(',') if c.strip()]
+        self.chat_id = self.chat_ids[0]
         self.instagram_username = instagram_username.replace('@', '')
-        self.base_url = f"https://api.telegram.org/bot{bot_token}"
         self.ig_sessionid = ig_sessionid
         
-        # Track sent stories
-        self.sent_stories = []
+        # Interruptible scheduling on an injectable clock
+        self.clock = clock or Clock()
+        self.scheduler = Scheduler(self.clock)
+        self.delivery_stop = threading.Event()
+        self.telegram = TelegramClient(bot_token, stop_event=self.delivery_stop, clock=self.clock)
+        
+        # Group new stories into sendMediaGroup albums (max 10 per album)
+        self.album_mode = album_mode
+        self.album_size = 10
+        
+        # All persistent state lives in one SQLite database
+        self.state_dir = state_dir
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.state = StateStore(os.path.join(self.state_dir, "state.db"), clock=self.clock)
+        
+        # Track sent stories (persisted across restarts)
+        self.sent_stories = SentStoriesStore(self.state, clock=self.clock)
+        
+        # Relay mode downloads media ourselves and uploads it to Telegram
+        self.relay_mode = relay_mode
+        self.media_cache = MediaCache(os.path.join(self.state_dir, "media_cache"), max_bytes=media_cache_bytes)
         
-        # Track followers changes
+        # story id -> Telegram file_id, so each media item is uploaded only once
+        self.file_ids = OrderedDict()
+        self.max_file_ids = 200
+        
+        # Deliveries are queued in a persistent outbox and sent by a background worker
+        self.outbox = Outbox(self.state, clock=self.clock)
+        self.delivery_thread = None
+        
+        # Content-level dedup of re-posted media: "reference", "suppress" or "off"
+        if dedup_mode not in self.DEDUP_MODES:
+            # A typo must not silently turn into "suppress" and drop re-posted stories
+            logger.warning(f"⚠️ Unknown DEDUP_MODE {dedup_mode!r}, using 'reference'")
+            dedup_mode = 'reference'
+        self.dedup_mode = dedup_mode
+        self.media_hashes = MediaHashIndex(self.state, window=timedelta(days=dedup_window_days), clock=self.clock)
+        
+        # Track followers changes (legacy JSON files are imported once)
         self.followers_file = "followers_data.json"
         self.following_file = "following_data.json"
         self.last_followers = self.load_followers_data()
         self.last_following = self.load_following_data()
         
+        # Target user lookups: the pk never changes, user_info is reused within a TTL
+        self.user_info_ttl = user_info_ttl
+        self.cached_user_info = None
+        self.cached_user_info_at = 0
+        target_user = self.state.load_snapshot('target_user') or {}
+        self.target_user_pk = target_user.get('pk') if target_user.get('username') == self.instagram_username else None
+        
         # Initialize Instagram client with stealth settings
+        self.client_class = client_class
         self.instagram_client = None
+        self.instagram_settings_file = os.path.join(self.state_dir, "instagram_settings.json")
+        self.session_restored = False  # Restored sessions are validated on first use
         self.is_working = False
         self.last_instagram_action = 0  # Track last Instagram action
         self.init_instagram_client()
@@ -41,207 +1160,283 @@ class StealthInstagramBot:
     
     def get_next_check_interval(self):
         """Calculate next check interval - EXTRA LONG intervals"""
-        current_time = datetime.now(ISRAEL_TZ)
+        current_time = self.clock.now(ISRAEL_TZ)
         current_hour = current_time.hour
         
         # Night hours (11 PM - 8 AM): Check every 4-8 hours
         if current_hour >= 23 or current_hour < 8:
             random_hours = random.uniform(4, 8)  # 4-8 hours
             minutes = int(random_hours * 60)
-            print(f"🌙 Night mode: Next check in {random_hours:.1f} hours")
+            logger.info(f"🌙 Night mode: Next check in {random_hours:.1f} hours")
             return minutes * 60
         
         # Day hours: Check every 2-4 hours (much longer than before)
         else:
             random_hours = random.uniform(2, 4)  # 2-4 hours
             minutes = int(random_hours * 60)
-            print(f"☀️ Day mode: Next check in {random_hours:.1f} hours")
+            logger.info(f"☀️ Day mode: Next check in {random_hours:.1f} hours")
             return minutes * 60
     
     def should_skip_this_check(self):
         """Randomly skip some checks to be less predictable"""
         # 40% chance to skip a check (increased from 20%)
         if random.random() < 0.4:
-            print("🎲 Randomly skipping this check to avoid detection")
+            logger.info("🎲 Randomly skipping this check to avoid detection")
             return True
         return False
         
     def init_instagram_client(self):
         """Initialize Instagram client with stealth settings"""
         try:
-            print("🔧 Initializing stealth Instagram client...")
-            self.instagram_client = Client()
+            logger.info("🔧 Initializing stealth Instagram client...")
+            self.instagram_client = self.client_class()
             
             # Stealth settings
             self.instagram_client.delay_range = [3, 7]  # Longer delays between requests
             
-            if self.ig_sessionid:
-                try:
-                    print("🔑 Using sessionid for login...")
-                    decoded_sessionid = urllib.parse.unquote(self.ig_sessionid)
-                    self.instagram_client.login_by_sessionid(decoded_sessionid)
-                    
-                    # Add delay after login
-                    time.sleep(self.get_stealth_delay())
-                    
-                    user_info = self.instagram_client.account_info()
-                    print(f"✅ Stealth login successful! Logged in as: {user_info.username}")
-                    self.is_working = True
-                    return True
-                    
-                except Exception as e:
-                    print(f"❌ Sessionid login failed: {e}")
-                    self.is_working = False
-                    return False
-            else:
-                print("❌ No sessionid provided")
+            if not self.ig_sessionid:
+                logger.error("❌ No sessionid provided")
                 self.is_working = False
                 return False
+            
+            if self.restore_instagram_session():
+                logger.debug("♻️ Restored saved Instagram session")
+                self.is_working = True
+                return True
+            
+            return self.login_instagram()
                 
         except Exception as e:
-            print(f"❌ Failed to initialize Instagram client: {e}")
+            logger.error(f"❌ Failed to initialize Instagram client: {e}")
             self.is_working = False
             return False
     
+    def restore_instagram_session(self):
+        """Load saved client settings and device state, without hitting Instagram"""
+        if not os.path.exists(self.instagram_settings_file):
+            return False
+        
+        try:
+            settings = self.instagram_client.load_settings(self.instagram_settings_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Could not load saved Instagram session: {e}")
+            return False
+        
+        # A new IG_SESSIONID replaces whatever was saved
+        saved_sessionid = (settings.get('authorization_data') or {}).get('sessionid')
+        if saved_sessionid != urllib.parse.unquote(self.ig_sessionid):
+            logger.info("🔑 Sessionid changed, ignoring saved session")
+            return False
+        
+        self.session_restored = True
+        return True
+    
+    def login_instagram(self):
+        """Full login by sessionid, then save the session for the next start"""
+        try:
+            logger.info("🔑 Using sessionid for login...")
+            decoded_sessionid = urllib.parse.unquote(self.ig_sessionid)
+            with metrics.timer('odwatch_phase_seconds', {'phase': 'login'}):
+                self.instagram_client.login_by_sessionid(decoded_sessionid)
+            
+            logger.info(f"✅ Stealth login successful! Logged in as: {self.instagram_client.username}")
+            self.session_restored = False
+            self.is_working = True
+            self.save_instagram_session()
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ Sessionid login failed: {e}")
+            self.is_working = False
+            return False
+    
+    def save_instagram_session(self):
+        """Atomically dump client settings to the state directory"""
+        tmp_file = self.instagram_settings_file + ".tmp"
+        try:
+            self.instagram_client.dump_settings(tmp_file)
+            os.replace(tmp_file, self.instagram_settings_file)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not save Instagram session: {e}")
+    
+    def instagram_call(self, method, *args):
+        """Call an Instagram client method, re-logging in once if a restored session is rejected"""
+        try:
+            result = self.timed_instagram_call(method, *args)
+        except (LoginRequired, ClientLoginRequired, ClientUnauthorizedError) as e:
+            if not self.session_restored:
+                raise
+            logger.warning(f"⚠️ Saved Instagram session rejected ({e}), logging in again...")
+            if not self.login_instagram():
+                raise
+            result = self.timed_instagram_call(method, *args)
+        
+        if self.session_restored:
+            # First successful call validates the restored session (logins save on their own)
+            self.session_restored = False
+            logger.info("✅ Saved Instagram session is valid")
+            self.save_instagram_session()
+        return result
+    
+    def timed_instagram_call(self, method, *args):
+        """Call an Instagram client method, recording its latency and outcome"""
+        status = 'failure'
+        try:
+            with metrics.timer('odwatch_instagram_call_seconds', {'method': method}):
+                result = getattr(self.instagram_client, method)(*args)
+            status = 'success'
+            return result
+        finally:
+            metrics.inc('odwatch_instagram_calls_total', {'method': method, 'status': status})
+    
     def instagram_action_delay(self):
         """Ensure minimum delay between Instagram actions"""
-        current_time = time.time()
+        current_time = self.clock.time()
         time_since_last = current_time - self.last_instagram_action
         min_delay = 30  # Minimum 30 seconds between Instagram actions (increased from 15)
         
         if time_since_last < min_delay:
             sleep_time = min_delay - time_since_last + random.uniform(0, 15)  # Added more random delay
-            print(f"⏳ Waiting {sleep_time:.1f}s between Instagram actions...")
-            time.sleep(sleep_time)
+            logger.debug(f"⏳ Waiting {sleep_time:.1f}s between Instagram actions...")
+            self.scheduler.pause(sleep_time)
         
-        self.last_instagram_action = time.time()
+        self.last_instagram_action = self.clock.time()
+    
+    def load_snapshot(self, name, legacy_file):
+        """Load a snapshot from the state store, importing the legacy JSON file once"""
+        empty = {"count": None, "ids": [], "initialized": False}
+        data = self.state.load_snapshot(name)
+        if data is not None:
+            return data
+        
+        if os.path.exists(legacy_file):
+            try:
+                with open(legacy_file, 'r') as f:
+                    data = json.load(f)
+                self.state.save_snapshots({name: data})
+                logger.info(f"📂 Imported {legacy_file} into state store")
+                return data
+            except (OSError, ValueError) as e:
+                logger.warning(f"⚠️ Could not import {legacy_file}: {e}")
+        return empty
     
     def load_followers_data(self):
         """Load previous followers data"""
-        try:
-            if os.path.exists(self.followers_file):
-                with open(self.followers_file, 'r') as f:
-                    return json.load(f)
-            return {"count": None, "ids": [], "initialized": False}
-        except:
-            return {"count": None, "ids": [], "initialized": False}
-    
-    def save_followers_data(self, followers_data):
-        """Save current followers data"""
-        try:
-            with open(self.followers_file, 'w') as f:
-                json.dump(followers_data, f)
-        except Exception as e:
-            print(f"❌ Error saving followers data: {e}")
+        return self.load_snapshot('followers', self.followers_file)
     
     def load_following_data(self):
         """Load previous following data"""
+        return self.load_snapshot('following', self.following_file)
+    
+    def record_counts(self, followers_count, following_count):
+        """Append observed counts to the follower/following history"""
         try:
-            if os.path.exists(self.following_file):
-                with open(self.following_file, 'r') as f:
-                    return json.load(f)
-            return {"count": None, "ids": [], "initialized": False}
-        except:
-            return {"count": None, "ids": [], "initialized": False}
-    
-    def save_following_data(self, following_data):
-        """Save current following data"""
-        try:
-            with open(self.following_file, 'w') as f:
-                json.dump(following_data, f)
-        except Exception as e:
-            print(f"❌ Error saving following data: {e}")
+            now = self.clock.time()
+            self.state.record_count('followers', followers_count, now)
+            self.state.record_count('following', following_count, now)
+        except sqlite3.Error as e:
+            logger.error(f"❌ Error recording counts: {e}")
     
-    def send_telegram_message(self, message):
-        """Send text message to Telegram"""
-        url = f"{self.base_url}/sendMessage"
-        payload = {
-            'chat_id': self.chat_id,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
+    def send_telegram_message(self, message, chat_id=None):
+        """Send text message to Telegram (to every destination chat by default)"""
+        chat_ids = [chat_id] if chat_id else self.chat_ids
+        sent = False
         
-        try:
-            response = requests.post(url, data=payload, timeout=30)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ Error sending message: {e}")
-            return False
+        for target in chat_ids:
+            payload = {
+                'chat_id': target,
+                'text': message,
+                'parse_mode': 'HTML'
+            }
+            try:
+                if self.telegram.call('sendMessage', data=payload, timeout=30) is not None:
+                    sent = True
+            except DeliveryUnconfirmed:
+                if chat_id:
+                    raise
+                # Broadcasting: possibly delivered, carry on with the other chats
+                sent = True
+        
+        return sent
     
-    def send_telegram_photo(self, photo_url, caption=""):
-        """Send photo URL to Telegram"""
-        url = f"{self.base_url}/sendPhoto"
+    def send_telegram_media(self, media_type, media, caption="", path=None, chat_id=None):
+        """Send a photo/video by URL or file_id (or upload a local file), returns the sent message or None"""
+        method = 'sendVideo' if media_type == 'video' else 'sendPhoto'
         payload = {
-            'chat_id': self.chat_id,
-            'photo': photo_url,
+            'chat_id': chat_id or self.chat_id,
             'caption': caption[:1024],
             'parse_mode': 'HTML'
         }
         
-        try:
-            response = requests.post(url, data=payload, timeout=60)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ Error sending photo: {e}")
-            return False
+        if path:
+            return self.telegram.upload(method, payload, {media_type: path})
+        payload[media_type] = media
+        return self.telegram.call(method, data=payload, timeout=60)
     
-    def send_telegram_video(self, video_url, caption=""):
-        """Send video URL to Telegram"""
-        url = f"{self.base_url}/sendVideo"
-        payload = {
-            'chat_id': self.chat_id,
-            'video': video_url,
-            'caption': caption[:1024],
-            'parse_mode': 'HTML'
-        }
+    def get_target_user_info(self):
+        """Get the target's user info, reusing a result younger than user_info_ttl"""
+        if self.cached_user_info and self.clock.time() - self.cached_user_info_at < self.user_info_ttl:
+            metrics.cache('user_info', hit=True)
+            logger.debug(f"♻️ Using cached user info for @{self.instagram_username}")
+            return self.cached_user_info
+        metrics.cache('user_info', hit=False)
         
-        try:
-            response = requests.post(url, data=payload, timeout=60)
-            return response.status_code == 200
-        except Exception as e:
-            print(f"❌ Error sending video: {e}")
-            return False
+        # Add delay before Instagram action
+        self.instagram_action_delay()
+        
+        user_info = self.instagram_call('user_info_by_username', self.instagram_username)
+        self.cached_user_info = user_info
+        self.cached_user_info_at = self.clock.time()
+        logger.info(f"✅ Found user: {user_info.full_name}")
+        
+        if str(user_info.pk) != str(self.target_user_pk):
+            self.target_user_pk = str(user_info.pk)
+            self.state.save_snapshots({
+                'target_user': {'username': self.instagram_username, 'pk': self.target_user_pk}
+            })
+        return user_info
     
     def get_user_stories_stealth(self):
         """Get Instagram stories with stealth approach"""
         if not self.instagram_client or not self.is_working:
-            print("❌ Instagram client not working")
+            logger.error("❌ Instagram client not working")
             return []
         
         try:
-            # Add delay before Instagram action
-            self.instagram_action_delay()
+            logger.info(f"📱 Getting stories for @{self.instagram_username}...")
             
-            print(f"📱 Getting stories for @{self.instagram_username}...")
-            
-            # Get user info with delay
-            user_info = self.instagram_client.user_info_by_username(self.instagram_username)
-            user_id = user_info.pk
-            print(f"✅ Found user: {user_info.full_name}")
-            
-            # Random delay between actions
-            time.sleep(self.get_stealth_delay())
+            metrics.cache('user_pk', hit=bool(self.target_user_pk))
+            if self.target_user_pk:
+                # Known pk, fetch stories by id directly
+                user_id = self.target_user_pk
+                self.instagram_action_delay()
+            else:
+                user_id = str(self.get_target_user_info().pk)
+                
+                # Random delay between actions
+                self.scheduler.pause(self.get_stealth_delay())
             
             try:
-                user_stories = self.instagram_client.user_stories(user_id)
+                user_stories = self.instagram_call('user_stories', user_id)
                 
                 if not user_stories:
-                    print(f"ℹ️ No active stories found")
+                    logger.info("ℹ️ No active stories found")
                     return []
                 
                 stories = []
-                print(f"📸 Found {len(user_stories)} stories")
+                logger.info(f"📸 Found {len(user_stories)} stories")
                 
                 for i, story in enumerate(user_stories):
                     try:
                         story_id = f"story_{story.pk}"
                         
-                        # Skip if already sent
-                        if story_id in self.sent_stories:
-                            print(f"⏭️ Story already sent, skipping")
+                        # Skip if already sent or waiting in the outbox
+                        if story_id in self.sent_stories or self.outbox.has_story(story_id):
+                            metrics.inc('odwatch_stories_skipped_total')
+                            logger.debug("⏭️ Story already sent, skipping")
                             continue
                         
-                        print(f"🔍 Processing story {i+1}/{len(user_stories)}")
+                        logger.info(f"🔍 Processing story {i+1}/{len(user_stories)}")
                         
                         # Get media URL with stealth delays
                         media_url = None
@@ -258,132 +1453,445 @@ class StealthInstagramBot:
                                 media_url = getattr(story, 'url')
                                 media_type = 'photo'
                         except Exception as url_error:
-                            print(f"⚠️ Could not get direct URL: {url_error}")
+                            logger.warning(f"⚠️ Could not get direct URL: {url_error}")
                         
                         # Random delay between story processing
-                        time.sleep(random.uniform(5, 12))  # Increased from 2-5
+                        self.scheduler.pause(random.uniform(5, 12))  # Increased from 2-5
                         
                         if media_url:
                             story_data = {
                                 'id': story_id,
                                 'url': media_url,
                                 'type': media_type,
-                                'timestamp': getattr(story, 'taken_at', datetime.now(ISRAEL_TZ)),
-                                'story_pk': story.pk
+                                'timestamp': getattr(story, 'taken_at', self.clock.now(ISRAEL_TZ)),
+                                'story_pk': story.pk,
+                                'thumbnail_url': getattr(story, 'thumbnail_url', None)
                             }
                             
                             stories.append(story_data)
-                            print(f"✅ Added story to queue")
+                            logger.info("✅ Added story to queue")
                         
                     except Exception as story_error:
-                        print(f"❌ Error processing story: {story_error}")
+                        logger.error(f"❌ Error processing story: {story_error}")
                         continue
                 
-                print(f"📦 Returning {len(stories)} stories")
+                logger.info(f"📦 Returning {len(stories)} stories")
                 return stories
                 
             except Exception as stories_error:
-                print(f"❌ Error getting stories: {stories_error}")
+                logger.error(f"❌ Error getting stories: {stories_error}")
                 return []
                 
         except Exception as e:
-            print(f"❌ Error in get_user_stories_stealth: {e}")
+            logger.error(f"❌ Error in get_user_stories_stealth: {e}")
             return []
     
-    def process_stories(self):
+    def send_telegram_media_group(self, media_items, chat_id=None):
+        """Send up to 10 photos/videos as one Telegram album, returns the sent messages or None"""
+        media = []
+        files = {}
+        for i, item in enumerate(media_items[:10]):
+            if item.get('path'):
+                # Local files are attached to the same multipart request
+                files[f'file{i}'] = item['path']
+                media_ref = f'attach://file{i}'
+            else:
+                media_ref = item['url']
+            
+            media.append({
+                'type': item['type'],
+                'media': media_ref,
+                'caption': item.get('caption', '')[:1024],
+                'parse_mode': 'HTML'
+            })
+        
+        payload = {
+            'chat_id': chat_id or self.chat_id,
+            'media': json.dumps(media)
+        }
+        
+        if files:
+            return self.telegram.upload('sendMediaGroup', payload, files, cost=len(media))
+        # Each album item counts towards the chat's message limit
+        return self.telegram.call('sendMediaGroup', data=payload, timeout=120, cost=len(media))
+    
+    def build_story_caption(self, story):
+        """Build the '@user • dd/mm HH:MM' caption for a story"""
+        # Convert timestamp to Israel time
+        if story['timestamp'].tzinfo is None:
+            story_time = pytz.UTC.localize(story['timestamp']).astimezone(ISRAEL_TZ)
+        else:
+            story_time = story['timestamp'].astimezone(ISRAEL_TZ)
+        
+        return f"@{self.instagram_username} • {story_time.strftime('%d/%m %H:%M')}"
+    
+    def mark_story_sent(self, story):
+        """Record a delivered story until it expires"""
+        self.sent_stories.add(story['id'], story['timestamp'])
+    
+    def remember_media_hash(self, story):
+        """Index a delivered story's media so later re-posts are recognized"""
+        if not story.get('media_hash'):
+            return
+        value = int(story['media_hash'], 16)
+        # Fan-out delivers the same story to every chat, index it once
+        if self.media_hashes.find(value) is None:
+            self.media_hashes.add(value, story['id'])
+    
+    def get_story_path(self, story):
+        """In relay mode, fetch the story media into the local cache"""
+        if not self.relay_mode:
+            return None
+        
+        path = self.media_cache.fetch(story['id'], story['url'], story['type'])
+        if not path:
+            logger.warning("⚠️ Relay failed, falling back to URL delivery")
+        return path
+    
+    def remember_file_id(self, story, message):
+        """Capture the file_id Telegram assigned to an uploaded story"""
+        if not isinstance(message, dict):
+            return
+        
+        file_id = None
+        if story['type'] == 'photo' and message.get('photo'):
+            # Photo sizes are ordered smallest first
+            file_id = message['photo'][-1].get('file_id')
+        else:
+            for key in ('video', 'animation', 'document'):
+                if message.get(key):
+                    file_id = message[key].get('file_id')
+                    break
+        
+        if file_id:
+            self.file_ids[story['id']] = file_id
+            self.file_ids.move_to_end(story['id'])
+            while len(self.file_ids) > self.max_file_ids:
+                self.file_ids.popitem(last=False)
+    
+    def get_story_media(self, story):
+        """Return (media, path) for a story, reusing a known file_id when possible"""
+        file_id = self.file_ids.get(story['id'])
+        metrics.cache('file_id', hit=file_id is not None)
+        if file_id:
+            return file_id, None
+        return story['url'], self.get_story_path(story)
+    
+    def send_story_to_chat(self, story, chat_id):
+        """Send a single story to one chat, returns True if delivered (raises DeliveryUnconfirmed)"""
+        try:
+            caption = self.build_story_caption(story)
+            media, path = self.get_story_media(story)
+            
+            message = self.send_telegram_media(story['type'], media, caption, path, chat_id)
+            if message is None:
+                if self.file_ids.get(story['id']) == media:
+                    # Don't reuse a file_id Telegram rejected, the next attempt sends the URL or file
+                    del self.file_ids[story['id']]
+                    logger.info(f"♻️ Dropped cached file_id for {story['id']}")
+                return False
+            
+            self.remember_file_id(story, message)
+            return True
+            
+        except DeliveryUnconfirmed:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error processing story: {e}")
+            return False
+    
+    def send_stories_one_by_one(self, stories, chat_id):
+        """Send stories as single messages to one chat, returns (delivered, unconfirmed)"""
+        delivered = []
+        unconfirmed = []
+        for story in stories:
+            try:
+                if self.send_story_to_chat(story, chat_id):
+                    delivered.append(story)
+            except DeliveryUnconfirmed:
+                unconfirmed.append(story)
+        return delivered, unconfirmed
+    
+    def send_story_album_to_chat(self, stories, chat_id):
+        """Send a group of stories as one album to one chat, returns (delivered, unconfirmed)
+
+        Falls back to single sends only when Telegram definitely did not post the album.
+        """
+        messages = None
+        try:
+            media_items = []
+            for story in stories:
+                media, path = self.get_story_media(story)
+                media_items.append({
+                    'type': story['type'],
+                    'url': media,
+                    'path': path,
+                    'caption': self.build_story_caption(story)
+                })
+            
+            messages = self.send_telegram_media_group(media_items, chat_id)
+        except DeliveryUnconfirmed:
+            # The album may be in the chat already, single sends could post it twice
+            logger.warning("⚠️ Album unconfirmed, not falling back to single sends")
+            return [], list(stories)
+        except Exception as e:
+            logger.error(f"❌ Error sending album: {e}")
+        
+        if messages is not None:
+            for story, message in zip(stories, messages):
+                self.remember_file_id(story, message)
+            return list(stories), []
+        
+        logger.warning("⚠️ Album failed, falling back to single sends")
+        return self.send_stories_one_by_one(stories, chat_id)
+    
+    def process_stories(self, force=False):
         """Process and send stories with stealth delays"""
         if not self.is_working:
-            print("⚠️ Instagram client not working, skipping stories")
+            logger.warning("⚠️ Instagram client not working, skipping stories")
             return
         
-        # Random chance to skip
-        if self.should_skip_this_check():
+        # Random chance to skip (unless the run was requested on demand)
+        if not force and self.should_skip_this_check():
             return
         
+        # Drop stories that have expired from Instagram
+        self.sent_stories.prune()
+        
         stories = self.get_user_stories_stealth()
         
         if not stories:
-            print("ℹ️ No new stories to process")
+            logger.info("ℹ️ No new stories to process")
             return
         
-        print(f"📱 Processing {len(stories)} stories")
+        if self.dedup_mode != 'off':
+            stories = self.filter_reposted_stories(stories)
+            if not stories:
+                return
+        
+        logger.info(f"📱 Queueing {len(stories)} stories")
+        self.enqueue_stories(stories)
+    
+    def get_story_hash(self, story):
+        """Perceptual hash of a photo, or of a video's thumbnail; None if unavailable"""
+        try:
+            if story['type'] == 'photo' and self.relay_mode:
+                # The relay needs the file anyway, so hash the cached copy
+                path = self.media_cache.fetch(story['id'], story['url'], story['type'])
+                if not path:
+                    return None
+                with Image.open(path) as image:
+                    return MediaHashIndex.compute_hash(image)
+            
+            url = story['url'] if story['type'] == 'photo' else story.get('thumbnail_url')
+            if not url:
+                return None
+            data = self.media_cache.fetch_bytes(url)
+            if not data:
+                return None
+            with Image.open(io.BytesIO(data)) as image:
+                return MediaHashIndex.compute_hash(image)
+                
+        except Exception as e:
+            logger.warning(f"⚠️ Could not hash story media: {e}")
+            return None
+    
+    def filter_reposted_stories(self, stories):
+        """Drop stories whose media was already sent, optionally sending a text reference instead"""
+        self.media_hashes.prune()
+        fresh = []
+        batch = []  # (hash, story_id) of fresh stories in this batch, indexed only once delivered
         
         for story in stories:
+            value = self.get_story_hash(story)
+            if value is None or not self.media_hashes.is_distinctive(value):
+                fresh.append(story)
+                continue
+            
+            match = self.media_hashes.find(value)
+            if match is None:
+                match = next(((story_id, self.clock.time()) for other, story_id in batch
+                              if self.media_hashes.matches(value, other)), None)
+            metrics.cache('media_hash', hit=match is not None)
+            if match is None:
+                story['media_hash'] = format(value, '016x')
+                batch.append((value, story['id']))
+                fresh.append(story)
+                continue
+            
+            original_id, seen_at = match
+            logger.info(f"♻️ Story {story['id']} repeats {original_id}, not sending media again")
+            if self.dedup_mode == 'reference':
+                first_sent = datetime.fromtimestamp(seen_at, tz=ISRAEL_TZ).strftime('%d/%m %H:%M')
+                self.enqueue_message(f"{self.build_story_caption(story)}\n♻️ Re-posted story (first sent {first_sent})")
+            self.mark_story_sent(story)
+        
+        return fresh
+    
+    def serialize_story(self, story):
+        return dict(story, timestamp=story['timestamp'].isoformat())
+    
+    def deserialize_story(self, story):
+        return dict(story, timestamp=datetime.fromisoformat(story['timestamp']))
+    
+    def enqueue_stories(self, stories):
+        """Queue story deliveries: one job per album (or story) per destination chat"""
+        group_size = self.album_size if self.album_mode else 1
+        for i in range(0, len(stories), group_size):
+            group = [self.serialize_story(story) for story in stories[i:i + group_size]]
+            for chat_id in self.chat_ids:
+                self.outbox.put({'kind': 'stories', 'chat_id': chat_id, 'stories': group})
+    
+    def enqueue_message(self, message):
+        """Queue a text message for every destination chat"""
+        for chat_id in self.chat_ids:
+            self.outbox.put({'kind': 'message', 'chat_id': chat_id, 'text': message})
+    
+    def deliver_job(self, entry):
+        """Run one outbox job, then complete or reschedule it; False if abandoned for shutdown"""
+        job = entry['job']
+        
+        if job['kind'] == 'message':
             try:
-                # Convert timestamp to Israel time
-                if story['timestamp'].tzinfo is None:
-                    story_time = pytz.UTC.localize(story['timestamp']).astimezone(ISRAEL_TZ)
-                else:
-                    story_time = story['timestamp'].astimezone(ISRAEL_TZ)
-                
-                # Clean caption
-                caption = f"@{self.instagram_username} • {story_time.strftime('%d/%m %H:%M')}"
-                
-                success = False
-                if story['type'] == 'video':
-                    success = self.send_telegram_video(story['url'], caption)
-                else:
-                    success = self.send_telegram_photo(story['url'], caption)
+                sent = self.send_telegram_message(job['text'], chat_id=job['chat_id'])
+            except DeliveryUnconfirmed:
+                # Telegram has no idempotency key, so a replay could post the message twice
+                logger.warning(f"⚠️ Message to chat {job['chat_id']} unconfirmed, not resending")
+                sent = True
+            if sent:
+                self.outbox.complete(entry)
+            elif self.delivery_stop.is_set():
+                # Abandoned by shutdown: keep attempts and schedule for the next start
+                return False
+            else:
+                self.outbox.retry(entry)
+            return True
+        
+        # Stories that have expired on Instagram are not worth retrying
+        stories = [self.deserialize_story(story) for story in job['stories']]
+        stories = [story for story in stories
+                   if self.sent_stories.get_expiry(story['timestamp']) > self.clock.time()]
+        
+        if len(stories) > 1:
+            delivered, unconfirmed = self.send_story_album_to_chat(stories, job['chat_id'])
+        else:
+            delivered, unconfirmed = self.send_stories_one_by_one(stories, job['chat_id'])
+        
+        # Unconfirmed sends probably went out and can't be replayed safely, so count them as sent
+        for story in delivered + unconfirmed:
+            self.mark_story_sent(story)
+            self.remember_media_hash(story)
+        if delivered:
+            logger.info(f"✅ Sent {len(delivered)} stories to chat {job['chat_id']}")
+        if unconfirmed:
+            logger.warning(f"⚠️ {len(unconfirmed)} stories to chat {job['chat_id']} unconfirmed, not resending")
+        
+        settled_ids = {story['id'] for story in delivered + unconfirmed}
+        remaining = [story for story in stories if story['id'] not in settled_ids]
+        metrics.inc('odwatch_stories_delivered_total', value=len(delivered))
+        metrics.inc('odwatch_stories_unconfirmed_total', value=len(unconfirmed))
+        abandoned = bool(remaining) and self.delivery_stop.is_set()
+        if abandoned:
+            # Abandoned by shutdown: keep attempts and schedule for the next start
+            logger.info(f"📬 Leaving {len(remaining)} stories in the outbox")
+            self.outbox.update(entry, dict(job, stories=[self.serialize_story(story) for story in remaining]))
+        elif remaining:
+            metrics.inc('odwatch_stories_failed_total', value=len(remaining))
+            logger.error(f"❌ Failed to send {len(remaining)} stories")
+            job = dict(job, stories=[self.serialize_story(story) for story in remaining])
+            self.outbox.retry(entry, job)
+        else:
+            self.outbox.complete(entry)
+        
+        if self.relay_mode:
+            # Keep the relay cache within its disk budget
+            self.media_cache.evict()
+        return not abandoned
+    
+    def delivery_loop(self):
+        """Background worker that drains the outbox (due jobs are flushed before stopping)"""
+        while True:
+            try:
+                entry = self.outbox.next_due()
+                if entry is None:
+                    if self.delivery_stop.is_set():
+                        break
+                    wait = self.outbox.seconds_until_next()
+                    self.clock.wait(self.outbox.wakeup, 60 if wait is None else min(wait, 60))
+                    self.outbox.wakeup.clear()
+                    continue
                 
-                if success:
-                    print(f"✅ Sent story: {story['type']}")
-                    self.sent_stories.append(story['id'])
+                # Sends are paced by the Telegram client's rate limiter
+                with metrics.timer('odwatch_phase_seconds', {'phase': 'delivery_job'}):
+                    if not self.deliver_job(entry):
+                        break
                     
-                    # Keep only last 50 sent stories
-                    if len(self.sent_stories) > 50:
-                        self.sent_stories = self.sent_stories[-50:]
-                else:
-                    print(f"❌ Failed to send story")
-                
-                # Random delay between sends
-                time.sleep(random.uniform(15, 30))  # Increased from 8-15
-                
             except Exception as e:
-                print(f"❌ Error processing story: {e}")
+                logger.error(f"❌ Delivery worker error: {e}")
+                if self.clock.wait(self.delivery_stop, 60):
+                    break
     
-    def check_followers_changes_stealth(self):
+    def start_delivery_worker(self):
+        """Start the background delivery thread"""
+        if self.delivery_thread and self.delivery_thread.is_alive():
+            return
+        self.delivery_stop.clear()
+        self.telegram.rate_limiter.drain_deadline = None
+        self.delivery_thread = threading.Thread(target=self.delivery_loop, name="delivery", daemon=True)
+        self.delivery_thread.start()
+    
+    def stop_delivery_worker(self, timeout=30):
+        """Stop the background delivery thread; undelivered jobs stay in the outbox"""
+        # Due jobs are still flushed, with pacing waits allowed up to the timeout
+        self.telegram.rate_limiter.drain_deadline = self.clock.time() + timeout
+        self.delivery_stop.set()
+        self.outbox.wakeup.set()
+        if self.delivery_thread:
+            self.delivery_thread.join(timeout)
+    
+    def check_followers_changes_stealth(self, force=False):
         """Check for followers changes with stealth approach - LESS FREQUENT"""
         if not self.instagram_client or not self.is_working:
-            print("⚠️ Instagram client not working, skipping followers check")
+            logger.warning("⚠️ Instagram client not working, skipping followers check")
             return
         
         # Only check followers every 4th time (reduce API calls even more)
-        if random.random() < 0.75:  # 75% chance to skip followers check (increased from 66%)
-            print("🎲 Skipping followers check this time")
+        if not force and random.random() < 0.75:  # 75% chance to skip followers check (increased from 66%)
+            logger.info("🎲 Skipping followers check this time")
             return
         
         try:
-            # Add delay before Instagram action
-            self.instagram_action_delay()
-            
-            print(f"👥 Checking followers changes...")
+            logger.info("👥 Checking followers changes...")
             
-            # Get user info
-            user_info = self.instagram_client.user_info_by_username(self.instagram_username)
+            # Get user info (shared with the stories fetch within the TTL)
+            user_info = self.get_target_user_info()
             current_followers_count = user_info.follower_count
             current_following_count = user_info.following_count
+            self.record_counts(current_followers_count, current_following_count)
             
             # Check if this is first time running
             is_first_run = not self.last_followers.get('initialized', False)
             
             if is_first_run:
-                print("🆕 First run - initializing followers data")
+                logger.info("🆕 First run - initializing followers data")
                 
                 self.last_followers = {
                     'count': current_followers_count,
                     'ids': [],
                     'initialized': True,
-                    'last_updated': datetime.now(ISRAEL_TZ).isoformat()
+                    'last_updated': self.clock.now(ISRAEL_TZ).isoformat()
                 }
                 self.last_following = {
                     'count': current_following_count,
                     'ids': [],
                     'initialized': True,
-                    'last_updated': datetime.now(ISRAEL_TZ).isoformat()
+                    'last_updated': self.clock.now(ISRAEL_TZ).isoformat()
                 }
                 
-                self.save_followers_data(self.last_followers)
-                self.save_following_data(self.last_following)
+                self.state.save_snapshots({
+                    'followers': self.last_followers,
+                    'following': self.last_following
+                })
                 return
             
             # Get previous counts
@@ -398,6 +1906,7 @@ class StealthInstagramBot:
                 return
             
             messages = []
+            snapshots = {}
             
             if followers_changed:
                 if current_followers_count > last_followers_count:
@@ -407,8 +1916,7 @@ class StealthInstagramBot:
                     lost_count = last_followers_count - current_followers_count
                     messages.append(f"➖ {lost_count} unfollowed")
                 
-                self.last_followers['count'] = current_followers_count
-                self.save_followers_data(self.last_followers)
+                snapshots['followers'] = dict(self.last_followers, count=current_followers_count)
             
             if following_changed:
                 if current_following_count > last_following_count:
@@ -418,96 +1926,178 @@ class StealthInstagramBot:
                     unfollowed_count = last_following_count - current_following_count
                     messages.append(f"➖ Unfollowed {unfollowed_count} accounts")
                 
-                self.last_following['count'] = current_following_count
-                self.save_following_data(self.last_following)
+                snapshots['following'] = dict(self.last_following, count=current_following_count)
             
-            # Send message
-            if messages:
-                summary_time = datetime.now(ISRAEL_TZ).strftime('%d/%m %H:%M')
-                summary_msg = f"@{self.instagram_username} • {summary_time}\n" + "\n".join(messages)
-                self.send_telegram_message(summary_msg)
-                print(f"📱 Sent followers update")
+            summary_time = self.clock.now(ISRAEL_TZ).strftime('%d/%m %H:%M')
+            summary_msg = f"@{self.instagram_username} • {summary_time}\n" + "\n".join(messages)
+            
+            # New counts and their notification commit together, so a crash can't lose or repeat an update
+            with self.state.transaction():
+                self.state.save_snapshots(snapshots)
+                self.enqueue_message(summary_msg)
+            
+            self.last_followers = snapshots.get('followers', self.last_followers)
+            self.last_following = snapshots.get('following', self.last_following)
+            logger.info("📱 Queued followers update")
             
         except Exception as e:
-            print(f"❌ Error checking followers changes: {e}")
+            logger.error(f"❌ Error checking followers changes: {e}")
     
     def start_monitoring(self):
         """Start stealth monitoring"""
-        print(f"🥷 Starting STEALTH Instagram Monitor...")
-        print(f"👤 Monitoring: @{self.instagram_username}")
-        print(f"📱 Sending to Telegram chat: {self.chat_id}")
-        print(f"⏱️ Ultra stealth timing: 2-4h (day) | 4-8h (night)")
-        print(f"🎲 40% random skips, 75% follower skips enabled")
+        logger.info("🥷 Starting STEALTH Instagram Monitor...")
+        logger.info(f"👤 Monitoring: @{self.instagram_username}")
+        logger.info(f"📱 Sending to Telegram chats: {', '.join(self.chat_ids)}")
+        logger.info("⏱️ Ultra stealth timing: 2-4h (day) | 4-8h (night)")
+        logger.info("🎲 40% random skips, 75% follower skips enabled")
         
         if self.is_working:
             startup_msg = f"🥷 Ultra Stealth Bot • @{self.instagram_username}"
         else:
             startup_msg = f"🥷 Ultra Stealth Bot • Not connected"
         
-        self.send_telegram_message(startup_msg)
+        self.install_signal_handlers()
+        self.start_delivery_worker()
+        self.enqueue_message(startup_msg)
         
         # Don't check immediately - wait for first interval
-        print("⏳ Starting with delay to avoid detection...")
+        logger.info("⏳ Starting with delay to avoid detection...")
         
         # Main loop with stealth timing
-        while True:
-            try:
+        run_now = False  # An on-demand run was requested while backing off after an error
+        try:
+            while not self.scheduler.stopping:
                 if not self.is_working:
-                    print("🛑 Instagram client not working, stopping...")
+                    logger.info("🛑 Instagram client not working, stopping...")
                     break
                 
-                # Get next interval (much longer now)
-                next_interval = self.get_next_check_interval()
-                
-                current_time = datetime.now(ISRAEL_TZ)
-                next_check_time = datetime.fromtimestamp(
-                    current_time.timestamp() + next_interval, 
-                    tz=ISRAEL_TZ
-                )
-                
-                print(f"⏳ Next check: {next_check_time.strftime('%d/%m %H:%M')}")
-                time.sleep(next_interval)
-                
-                print(f"🔄 Running stealth checks at {datetime.now(ISRAEL_TZ).strftime('%H:%M:%S')}")
-                
-                # Process stories (with random skips)
-                self.process_stories()
-                
-                # Random delay between story and follower checks
-                time.sleep(random.uniform(60, 180))  # 1-3 minutes (increased from 30-90 seconds)
-                
-                # Check followers (less frequently)
-                self.check_followers_changes_stealth()
+                if run_now:
+                    reason = 'run'
+                    run_now = False
+                else:
+                    # Get next interval (much longer now)
+                    next_interval = self.get_next_check_interval()
+                    next_check_time = self.clock.now(ISRAEL_TZ) + timedelta(seconds=next_interval)
+                    logger.info(f"⏳ Next check: {next_check_time.strftime('%d/%m %H:%M')}")
+                    
+                    reason = self.scheduler.wait_for_next_run(next_interval)
+                    if reason == 'stop':
+                        break
                 
-            except KeyboardInterrupt:
-                print("\n🛑 Stealth bot stopped by user")
-                break
-            except Exception as e:
-                print(f"❌ Unexpected error: {e}")
-                # Longer retry delay
-                print("⏳ Error occurred, retrying in 1 hour...")
-                time.sleep(3600)  # 1 hour (increased from 30 minutes)
+                try:
+                    self.run_checks(force=(reason == 'run'))
+                except ShutdownRequested:
+                    break
+                except Exception as e:
+                    logger.error(f"❌ Unexpected error: {e}")
+                    # Longer retry delay
+                    logger.info("⏳ Error occurred, retrying in 1 hour...")
+                    reason = self.scheduler.wait_for_next_run(3600)  # 1 hour (increased from 30 minutes)
+                    if reason == 'stop':
+                        break
+                    run_now = reason == 'run'
+        except KeyboardInterrupt:
+            logger.info("🛑 Stealth bot stopped by user")
+        finally:
+            self.shutdown()
+    
+    def run_checks(self, force=False):
+        """One check cycle: stories, then followers"""
+        logger.info(f"🔄 Running {'on-demand' if force else 'stealth'} checks at "
+                    f"{self.clock.now(ISRAEL_TZ).strftime('%H:%M:%S')}")
+        
+        metrics.inc('odwatch_cycles_total')
+        
+        # Process stories (with random skips)
+        with metrics.timer('odwatch_phase_seconds', {'phase': 'process_stories'}):
+            self.process_stories(force=force)
+        
+        # Random delay between story and follower checks
+        self.scheduler.pause(random.uniform(60, 180))  # 1-3 minutes (increased from 30-90 seconds)
+        
+        # Check followers (less frequently)
+        with metrics.timer('odwatch_phase_seconds', {'phase': 'check_followers'}):
+            self.check_followers_changes_stealth(force=force)
+    
+    def install_signal_handlers(self):
+        """SIGTERM/SIGINT shut down gracefully, SIGUSR1 runs a check immediately"""
+        def handle_stop(signum, frame):
+            logger.info(f"🛑 Received {signal.Signals(signum).name}, shutting down...")
+            self.scheduler.request_stop()
+        
+        def handle_run(signum, frame):
+            logger.info("⚡ Received SIGUSR1, running checks now")
+            self.scheduler.request_run()
+        
+        try:
+            signal.signal(signal.SIGTERM, handle_stop)
+            signal.signal(signal.SIGINT, handle_stop)
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, handle_run)
+        except ValueError:
+            # Signals can only be installed from the main thread
+            logger.warning("⚠️ Not in main thread, signal handlers not installed")
+    
+    def shutdown(self, timeout=8):
+        """Flush pending deliveries and state, then release resources"""
+        logger.info("🛑 Shutting down, flushing pending deliveries...")
+        self.scheduler.request_stop()
+        self.stop_delivery_worker(timeout)
+        
+        if self.delivery_thread and self.delivery_thread.is_alive():
+            logger.warning(f"⚠️ {len(self.outbox)} deliveries left in the outbox for the next start")
+        
+        if self.instagram_client and self.is_working:
+            self.save_instagram_session()
+        
+        # Don't close the Telegram session or the state store under a delivery still in flight
+        if not (self.delivery_thread and self.delivery_thread.is_alive()):
+            self.telegram.close()
+            self.state.close()
+        logger.info("👋 Shutdown complete")
 
 def main():
+    setup_logging(os.getenv('LOG_LEVEL', 'INFO'), os.getenv('LOG_FORMAT', 'text'))
+    
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     CHAT_ID = os.getenv('CHAT_ID') 
     INSTAGRAM_USERNAME = os.getenv('INSTAGRAM_USERNAME')
     IG_SESSIONID = os.getenv('IG_SESSIONID')
+    ALBUM_MODE = os.getenv('ALBUM_MODE', '1') != '0'
+    STATE_DIR = os.getenv('STATE_DIR', '.')
+    RELAY_MODE = os.getenv('RELAY_MODE', '0') == '1'
+    MEDIA_CACHE_MB = int(os.getenv('MEDIA_CACHE_MB', '500'))
+    USER_INFO_TTL = int(os.getenv('USER_INFO_TTL', '900'))
+    DEDUP_MODE = os.getenv('DEDUP_MODE', 'reference')
+    DEDUP_WINDOW_DAYS = float(os.getenv('DEDUP_WINDOW_DAYS', '7'))
+    METRICS_PORT = os.getenv('METRICS_PORT')
+    METRICS_DUMP_INTERVAL = int(os.getenv('METRICS_DUMP_INTERVAL', '300'))
     
     if not BOT_TOKEN or not CHAT_ID or not INSTAGRAM_USERNAME:
-        print("❌ Missing required environment variables!")
+        logger.error("❌ Missing required environment variables!")
         return
     
-    print(f"🥷 Starting stealth bot...")
-    print(f"👤 Target: @{INSTAGRAM_USERNAME}")
+    logger.info("🥷 Starting stealth bot...")
+    logger.info(f"👤 Target: @{INSTAGRAM_USERNAME}")
     
     if IG_SESSIONID:
-        print(f"🔑 Using Session ID authentication")
+        logger.info("🔑 Using Session ID authentication")
     else:
-        print("❌ No Session ID provided")
+        logger.error("❌ No Session ID provided")
         return
     
-    bot = StealthInstagramBot(BOT_TOKEN, CHAT_ID, INSTAGRAM_USERNAME, IG_SESSIONID)
+    # Optional local metrics endpoint, plus a periodic JSON dump in the state dir
+    if METRICS_PORT:
+        metrics.start_http_server(int(METRICS_PORT))
+    if METRICS_DUMP_INTERVAL > 0:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        metrics.start_json_dump(os.path.join(STATE_DIR, "metrics.json"), METRICS_DUMP_INTERVAL)
+    
+    bot = StealthInstagramBot(BOT_TOKEN, CHAT_ID, INSTAGRAM_USERNAME, IG_SESSIONID,
+                              album_mode=ALBUM_MODE, state_dir=STATE_DIR,
+                              relay_mode=RELAY_MODE, media_cache_bytes=MEDIA_CACHE_MB * 1024 * 1024,
+                              user_info_ttl=USER_INFO_TTL, dedup_mode=DEDUP_MODE,
+                              dedup_window_days=DEDUP_WINDOW_DAYS)
     bot.start_monitoring()
 
 if __name__ == "__main__":
@@ -0,0 +1,329 @@
+"""Tests for the delivery pipeline, on the benchmark's fake backends.
+
+    python -m pytest -q
+"""
+import json
+import os
+import sqlite3
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import pytz
+import requests
+
+import main
+from benchmark import FakeBotAPI, StubInstagramClient, VirtualClock, count_queued, drain_outbox
+
+
+def error(status, description="Bad Request"):
+    return status, {'ok': False, 'error_code': status, 'description': description}
+
+
+@pytest.fixture
+def api():
+    api = FakeBotAPI(latency=0)
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+@pytest.fixture
+def make_bot(tmp_path, api, clock, monkeypatch):
+    """Build bots sharing one state directory, like restarts of the same deployment"""
+    monkeypatch.setattr(StubInstagramClient, 'clock', clock)
+    monkeypatch.setattr(StubInstagramClient, 'cdn_url', api.url)
+    monkeypatch.setattr(StubInstagramClient, 'stories_per_cycle', 3)
+    monkeypatch.setattr(StubInstagramClient, 'video_ratio', 0.0)
+    monkeypatch.setattr(StubInstagramClient, 'repost_ratio', 0.0)
+    bots = []
+
+    def make(chat_id='-1001', bot_clock=None, **kwargs):
+        bot = main.StealthInstagramBot(
+            "TEST", chat_id, "target", "1" * 40, state_dir=str(tmp_path),
+            clock=bot_clock or clock, client_class=StubInstagramClient, **kwargs
+        )
+        bot.telegram.base_url = f"{api.url}/botTEST"
+        bots.append(bot)
+        return bot
+
+    yield make
+    for bot in bots:
+        bot.shutdown(timeout=1)
+
+
+def respond_with(api, responder):
+    """Route Bot API calls through responder(method, default), where default gives a success"""
+    default = api.respond
+    api.respond = lambda method, body=b'': responder(method, default)
+
+
+def time_out_after_sending(bot, methods):
+    """Make calls to methods reach the server, then fail as if the response timed out"""
+    post = bot.telegram.session.post
+
+    def timed_out(url, **kwargs):
+        response = post(url, **kwargs)
+        if url.rsplit('/', 1)[-1] in methods:
+            raise requests.ReadTimeout("Read timed out")
+        return response
+
+    bot.telegram.session.post = timed_out
+
+
+def test_album_fallback_marks_only_delivered_stories(api, make_bot):
+    bot = make_bot()
+    bot.instagram_client.new_cycle()
+    photos = []
+
+    def responder(method, default):
+        if method == 'sendMediaGroup':
+            return error(400)
+        if method == 'sendPhoto':
+            photos.append(method)
+            if len(photos) == 2:
+                return error(400)
+        return default(method)
+
+    respond_with(api, responder)
+    bot.process_stories(force=True)
+    bot.deliver_job(bot.outbox.next_due())
+
+    assert 'story_1001' in bot.sent_stories
+    assert 'story_1002' not in bot.sent_stories
+    assert 'story_1003' in bot.sent_stories
+
+    # Only the failed story is retried
+    rows = bot.state.query("SELECT job, attempts FROM outbox")
+    assert len(rows) == 1
+    assert [story['id'] for story in json.loads(rows[0][0])['stories']] == ['story_1002']
+    assert rows[0][1] == 1
+    assert bot.outbox.has_story('story_1002')
+
+
+def test_sent_stories_survive_restart(api, make_bot, clock):
+    bot = make_bot()
+    bot.instagram_client.new_cycle()
+    bot.process_stories(force=True)
+    drain_outbox(bot, clock)
+    assert api.requests == {'cdn': 3, 'sendMediaGroup': 1}
+    stories = bot.instagram_client.stories
+    bot.shutdown()
+
+    api.reset()
+    restarted = make_bot()
+    restarted.instagram_client.stories = stories
+    restarted.process_stories(force=True)
+
+    assert len(restarted.outbox) == 0
+    assert 'sendMediaGroup' not in api.requests
+    assert 'sendPhoto' not in api.requests
+
+
+def test_repost_detected_after_restart(api, make_bot, clock):
+    bot = make_bot()
+    bot.instagram_client.new_cycle()
+    bot.process_stories(force=True)
+    drain_outbox(bot, clock)
+    bot.shutdown()
+
+    # A new story re-posting the media of story 1001
+    restarted = make_bot()
+    restarted.instagram_client.stories = [SimpleNamespace(
+        pk=5000, video_url=None, thumbnail_url=f"{api.url}/media/1001.jpg",
+        taken_at=datetime.fromtimestamp(clock.time(), tz=pytz.UTC)
+    )]
+    restarted.process_stories(force=True)
+
+    assert count_queued(restarted, 'stories') == 0
+    assert count_queued(restarted, 'message') == 1
+    assert 'story_5000' in restarted.sent_stories
+
+
+def test_undelivered_media_is_not_indexed(api, make_bot, clock):
+    bot = make_bot()
+    bot.instagram_client.new_cycle()
+    respond_with(api, lambda method, default: error(400) if method != 'cdn' else default(method))
+
+    bot.process_stories(force=True)
+    bot.deliver_job(bot.outbox.next_due())
+    assert bot.media_hashes.entries == []
+
+    api.respond = FakeBotAPI.respond.__get__(api)
+    drain_outbox(bot, clock)
+    assert sorted(story_id for _, story_id, _ in bot.media_hashes.entries) == [
+        'story_1001', 'story_1002', 'story_1003'
+    ]
+
+
+def test_outbox_retry_persists_across_restart(api, make_bot, clock):
+    bot = make_bot()
+    bot.telegram.max_retries = 1
+    respond_with(api, lambda method, default: error(502, "Bad Gateway"))
+
+    bot.enqueue_message("hello")
+    bot.deliver_job(bot.outbox.next_due())
+
+    (attempts, next_attempt_at), = bot.state.query("SELECT attempts, next_attempt_at FROM outbox")
+    assert attempts == 1
+    assert next_attempt_at >= clock.time() + bot.outbox.retry_base
+    assert bot.outbox.next_due() is None
+    bot.shutdown()
+
+    api.respond = FakeBotAPI.respond.__get__(api)
+    api.reset()
+    restarted = make_bot()
+    assert len(restarted.outbox) == 1
+    drain_outbox(restarted, clock)
+
+    assert len(restarted.outbox) == 0
+    assert api.requests == {'sendMessage': 1}
+
+
+def test_rate_limit_honors_retry_after(api, make_bot, clock):
+    bot = make_bot()
+    calls = []
+
+    def responder(method, default):
+        calls.append(method)
+        if len(calls) == 1:
+            return 429, {
+                'ok': False, 'error_code': 429, 'description': "Too Many Requests: retry after 5",
+                'parameters': {'retry_after': 5}
+            }
+        return default(method)
+
+    respond_with(api, responder)
+    started = clock.time()
+    result = bot.telegram.call('sendMessage', data={'chat_id': '-1001', 'text': "hi"})
+
+    assert result is not None
+    assert calls == ['sendMessage', 'sendMessage']
+    assert clock.time() - started >= 5
+    bucket = bot.telegram.rate_limiter.get_chat_bucket('-1001')
+    assert bucket.rate < bucket.base_rate
+
+
+def test_shutdown_drains_paced_outbox(api, make_bot):
+    # Real clock and worker thread: a private chat allows ~1 message/s
+    bot = make_bot(chat_id='42', bot_clock=main.Clock())
+    for i in range(4):
+        bot.enqueue_message(f"message {i}")
+
+    bot.start_delivery_worker()
+    bot.shutdown(timeout=8)
+
+    assert not bot.delivery_thread.is_alive()
+    assert api.requests == {'sendMessage': 4}
+
+
+def test_shutdown_leaves_undrained_jobs_untouched(api, make_bot, tmp_path):
+    bot = make_bot(chat_id='42', bot_clock=main.Clock())
+    for i in range(4):
+        bot.enqueue_message(f"message {i}")
+    (scheduled,), = bot.state.query("SELECT MAX(next_attempt_at) FROM outbox")
+
+    bot.start_delivery_worker()
+    bot.shutdown(timeout=1.5)
+
+    assert not bot.delivery_thread.is_alive()
+    assert api.requests == {'sendMessage': 2}
+    state = main.StateStore(os.path.join(str(tmp_path), "state.db"))
+    try:
+        rows = state.query("SELECT attempts, next_attempt_at FROM outbox")
+    finally:
+        state.close()
+    assert len(rows) == 2
+    assert all(attempts == 0 and next_attempt_at <= scheduled for attempts, next_attempt_at in rows)
+
+
+def test_unconfirmed_message_is_not_resent(api, make_bot, clock):
+    bot = make_bot()
+    time_out_after_sending(bot, {'sendMessage'})
+
+    bot.enqueue_message("hello")
+    drain_outbox(bot, clock)
+
+    assert api.requests == {'sendMessage': 1}
+    assert len(bot.outbox) == 0
+
+
+def test_unconfirmed_album_is_not_resent(api, make_bot, clock):
+    bot = make_bot()
+    bot.instagram_client.new_cycle()
+    time_out_after_sending(bot, {'sendMediaGroup'})
+
+    bot.process_stories(force=True)
+    drain_outbox(bot, clock)
+
+    assert api.requests == {'cdn': 3, 'sendMediaGroup': 1}
+    assert len(bot.outbox) == 0
+    assert all(f"story_{pk}" in bot.sent_stories for pk in (1001, 1002, 1003))
+
+
+def test_unconfirmed_single_send_is_not_retried(api, make_bot, clock):
+    bot = make_bot(album_mode=False)
+    bot.instagram_client.new_cycle()
+    time_out_after_sending(bot, {'sendPhoto'})
+
+    bot.process_stories(force=True)
+    drain_outbox(bot, clock)
+
+    assert api.requests == {'cdn': 3, 'sendPhoto': 3}
+    assert len(bot.outbox) == 0
+    assert all(f"story_{pk}" in bot.sent_stories for pk in (1001, 1002, 1003))
+
+
+def test_rejected_file_id_is_not_reused(api, make_bot, clock):
+    bot = make_bot(chat_id='-1001,-1002', album_mode=False)
+    bot.instagram_client.new_cycle()
+
+    def respond(method, body=b''):
+        if b'FILE' in body:
+            return error(400, "Bad Request: wrong file identifier")
+        return FakeBotAPI.respond(api, method)
+
+    api.respond = respond
+    bot.process_stories(force=True)
+    drain_outbox(bot, clock)
+
+    # The second chat's file_id sends fail once each, then go out by URL
+    assert api.requests['sendPhoto'] == 9
+    assert len(bot.outbox) == 0
+
+
+def test_follower_update_commits_with_its_notification(make_bot):
+    bot = make_bot()
+    bot.check_followers_changes_stealth(force=True)
+    stub = bot.instagram_client
+    stub.follower_count += 5
+    stub.following_count += 1
+
+    put = bot.outbox.put
+
+    def crash(job):
+        put(job)
+        raise sqlite3.OperationalError("disk I/O error")
+
+    bot.outbox.put = crash
+    bot.cached_user_info = None
+    bot.check_followers_changes_stealth(force=True)
+
+    assert len(bot.outbox) == 0
+    assert bot.state.load_snapshot('followers')['count'] == 1000
+    assert bot.state.load_snapshot('following')['count'] == 300
+
+    bot.outbox.put = put
+    bot.check_followers_changes_stealth(force=True)
+
+    assert count_queued(bot, 'message') == 1
+    assert bot.state.load_snapshot('followers')['count'] == 1005
+    assert bot.state.load_snapshot('following')['count'] == 301
+
+
+def test_unknown_dedup_mode_falls_back_to_reference(make_bot):
+    assert make_bot(dedup_mode='supress').dedup_mode == 'reference'